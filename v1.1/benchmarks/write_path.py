@@ -0,0 +1,130 @@
+# benchmarks/write_path.py
+# Compares the download write path against the old 8 KB iter_content loop,
+# on a file served from a local HTTP server so the network isn't measured.
+# The write path hashes every byte with SHA-256, so the old loop is measured
+# with and without hashing. The server sends Accept-Ranges, as the sites' CDNs
+# do, so the write path preallocates; one run without it is measured as well.
+#   python benchmarks/write_path.py --size-mb 200 --runs 3
+import argparse
+import functools
+import hashlib
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scrapers import downloader
+
+BUFFER_SIZES = [64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class RangeHandler(QuietHandler):
+    # Serves single byte ranges and says so, like the sites' CDNs
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def send_head(self):
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if not match:
+            return super().send_head()
+        try:
+            f = open(self.translate_path(self.path), 'rb')
+        except OSError:
+            self.send_error(404)
+            return None
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            start = int(match[1])
+            end = min(int(match[2]), size - 1) if match[2] else size - 1
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        return io.BytesIO(body)
+
+def start_server(directory, handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def old_loop(hashed):
+    def fetch(url, file_name, session):
+        digest = hashlib.sha256()
+        with session.get(url, stream=True) as response:
+            with open(file_name, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=8192):
+                    if chunk:
+                        f.write(chunk)
+                        if hashed:
+                            digest.update(chunk)
+    return fetch
+
+def new_path(buffer_size):
+    config = {'download_buffer_size': buffer_size, 'download_segments': 1}
+    return lambda url, file_name, session: downloader.download_file(url, file_name, session, config)
+
+def measure(name, fetch, url, file_name, session, size, runs):
+    walls, cpus = [], []
+    for _ in range(runs):
+        if os.path.exists(file_name):
+            os.remove(file_name)
+        wall, cpu = time.perf_counter(), time.process_time()
+        fetch(url, file_name, session)
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+        if os.path.getsize(file_name) != size:
+            raise SystemExit(f"{name}: wrote {os.path.getsize(file_name)} of {size} bytes")
+    # Best of the runs, the others are mostly noise from the page cache
+    print(f"{name:<32} {size / min(walls) / 1e6:8.1f} MB/s {min(cpus):8.2f} s CPU")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the download write path.")
+    parser.add_argument('--size-mb', type=int, default=100)
+    parser.add_argument('--runs', type=int, default=3)
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        size = options.size_mb * 1024 * 1024
+        with open(os.path.join(directory, 'source.bin'), 'wb') as f:
+            for _ in range(options.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        servers = [start_server(directory, RangeHandler), start_server(directory, QuietHandler)]
+        url, plain_url = [f"http://127.0.0.1:{server.server_address[1]}/source.bin" for server in servers]
+        file_name = os.path.join(directory, 'target.bin')
+        session = requests.Session()
+
+        measure("iter_content 8 KB", old_loop(False), url, file_name, session, size, options.runs)
+        measure("iter_content 8 KB SHA-256", old_loop(True), url, file_name, session, size, options.runs)
+        for buffer_size in BUFFER_SIZES:
+            measure(f"readinto {buffer_size // 1024} KB", new_path(buffer_size), url, file_name, session,
+                    size, options.runs)
+        measure(f"readinto {downloader.DEFAULT_BUFFER_SIZE // 1024} KB no prealloc",
+                new_path(downloader.DEFAULT_BUFFER_SIZE), plain_url, file_name, session, size, options.runs)
+        for server in servers:
+            server.shutdown()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,22 @@
 # scraper.py
+import argparse
+import asyncio
 import json
 import logging
 import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
 from scrapers import (
+    batch,
+    blobstore,
+    catalog,
+    engine,
+    jobqueue,
     pexels_scraper,
     pixabay_scraper,
+    verify,
+    workqueue,
     # Add other scraper modules here
 )
 
@@ -139,28 +151,144 @@ def get_user_input():
     }
     return args, website_options
 
+def scrape_site(site, args, config):
+    start = time.time()
+    result = {'site': site, 'status': 'ok', 'downloaded': 0}
+    # Checkpointed, so running the same choices again after a crash resumes the job
+    queue = jobqueue.get_queue(config)
+    job_id = queue.add(site, args)
+    queue.set_status(job_id, 'running')
+    try:
+        if site == 'pexels':
+            downloaded = pexels_scraper.scrape(args, config, job_id)
+        elif site == 'pixabay':
+            downloaded = pixabay_scraper.scrape(args, config, job_id)
+        # Add other scrapers here
+        else:
+            logging.warning(f"No scraper available for {site}")
+            result['status'] = 'no scraper'
+            downloaded = None
+        result['downloaded'] = sum((downloaded or {}).values())
+        queue.set_status(job_id, 'done')
+    except engine.IncompleteRun as e:
+        # Not a crash: the job stays open for `python scraper.py resume`
+        logging.error(f"{site}: {e}")
+        print(f"{site.capitalize()}: {e}. Run 'python scraper.py resume' to finish it.")
+        result['status'] = 'failed'
+        result['downloaded'] = sum(e.results.values())
+        queue.set_status(job_id, 'failed', str(e))
+    except Exception as e:
+        logging.exception(f"An error occurred while scraping {site}")
+        with open(os.path.join('crash_reports', f'{site}_crash_report.txt'), 'w') as f:
+            f.write(str(e))
+        print(f"An error occurred while scraping {site}. Check crash reports.")
+        result['status'] = 'failed'
+        queue.set_status(job_id, 'failed', str(e))
+    result['elapsed'] = time.time() - start
+    return result
+
+def print_summary(results, elapsed):
+    print("\nSummary:")
+    for result in results:
+        print(f"{result['site'].capitalize()}: {result['status']}, {result['downloaded']} files in {result['elapsed']:.1f}s")
+    print(f"Total: {sum(result['downloaded'] for result in results)} files in {elapsed:.1f}s")
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Scrape no-copyright images and videos.")
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export-metadata', help="Write the metadata catalog out as JSON files")
+    export_parser.add_argument('--output', help="Directory for the JSON files (default: metadata_path)")
+    import_parser = commands.add_parser('import-metadata', help="Load metadata JSON files into the catalog")
+    import_parser.add_argument('files', nargs='+')
+    view_parser = commands.add_parser('build-view', help="Lay out links to the blob store as a directory tree")
+    view_parser.add_argument('output', help="Directory to create the view in")
+    view_parser.add_argument('--layout', default=blobstore.DEFAULT_LAYOUT,
+                             help="Path template using metadata fields, e.g. {website}/{keyword_dir}/{format_sanitized}")
+    view_parser.add_argument('--website')
+    view_parser.add_argument('--keywords', nargs='+', help="Only include these keyword sets")
+    commands.add_parser('store-library', help="Move files saved before the blob store existed into it")
+    verify_parser = commands.add_parser('verify', help="Check the library against the sizes and hashes in the catalog")
+    verify_parser.add_argument('--website')
+    verify_parser.add_argument('--quick', action='store_true', help="Only compare sizes, without reading the files")
+    jobs_parser = commands.add_parser('run-jobs', help="Run the scraping jobs of a JSON or YAML job file without prompts")
+    jobs_parser.add_argument('job_file')
+    jobs_parser.add_argument('--summary', help="Write the JSON summary to this file instead of printing it")
+    resume_parser = commands.add_parser('resume', help="Resume the jobs a crash or an error left unfinished")
+    resume_parser.add_argument('--summary', help="Write the JSON summary to this file instead of printing it")
+    coordinate_parser = commands.add_parser('coordinate', help="Split a job file into work units for the workers")
+    coordinate_parser.add_argument('job_file')
+    coordinate_parser.add_argument('--pages-per-unit', type=int, default=workqueue.DEFAULT_PAGES_PER_UNIT)
+    work_parser = commands.add_parser('work', help="Work through the queued work units, next to other workers")
+    work_parser.add_argument('--worker-id', default=f"{socket.gethostname()}-{os.getpid()}")
+    work_parser.add_argument('--summary', help="Write the JSON summary to this file instead of printing it")
+    commands.add_parser('work-status', help="Show how many work units are pending, leased, done or failed")
+    return parser.parse_args()
+
 def main():
+    command_line = parse_command_line()
     config = load_config()
     setup_logging(config['log_level'])
 
+    if command_line.command == 'export-metadata':
+        count = catalog.export_json(config, command_line.output)
+        print(f"Exported {count} metadata files.")
+        return
+    if command_line.command == 'import-metadata':
+        for path in command_line.files:
+            print(f"Imported {catalog.import_json(config, path)} entries from {path}")
+        return
+    if command_line.command == 'build-view':
+        count = blobstore.build_view(config, command_line.output, command_line.layout,
+                                     command_line.website, command_line.keywords)
+        print(f"Linked {count} files into {command_line.output}")
+        return
+    if command_line.command == 'store-library':
+        print(f"Moved {blobstore.import_library(config)} files into the blob store")
+        return
+    if command_line.command == 'verify':
+        outcomes = verify.verify_library(config, command_line.website, command_line.quick)
+        for outcome in verify.PROBLEMS:
+            for file_name in outcomes.get(outcome, []):
+                print(f"{outcome}: {file_name}")
+        print(', '.join(f"{len(names)} {outcome}" for outcome, names in sorted(outcomes.items())) or "No files to verify")
+        if any(outcomes.get(outcome) for outcome in verify.PROBLEMS):
+            raise SystemExit(1)
+        return
+    if command_line.command == 'coordinate':
+        units = batch.plan_units(batch.load_jobs(command_line.job_file), command_line.pages_per_unit)
+        print(f"Queued {workqueue.get_queue(config).add_units(units)} work units")
+        return
+    if command_line.command == 'work-status':
+        print(json.dumps(workqueue.get_queue(config).counts(), indent=4))
+        return
+    if command_line.command in ('run-jobs', 'resume', 'work'):
+        if command_line.command == 'run-jobs':
+            summary = asyncio.run(batch.run_jobs(batch.load_jobs(command_line.job_file), config))
+        elif command_line.command == 'resume':
+            summary = asyncio.run(batch.run_jobs(batch.unfinished_jobs(config), config))
+        else:
+            summary = asyncio.run(batch.run_worker(config, command_line.worker_id))
+        if command_line.summary:
+            with open(command_line.summary, 'w') as f:
+                json.dump(summary, f, indent=4)
+        else:
+            print(json.dumps(summary, indent=4))
+        if summary['status'] != 'ok':
+            raise SystemExit(1)  # Lets cron and other schedulers notice failed jobs
+        return
+
     args, website_options = get_user_input()
 
     selected_websites = [website_options[num] for num in args['websites'] if num in website_options]
 
-    for site in selected_websites:
-        try:
-            if site == 'pexels':
-                pexels_scraper.scrape(args, config)
-            elif site == 'pixabay':
-                pixabay_scraper.scrape(args, config)
-            # Add other scrapers here
-            else:
-                logging.warning(f"No scraper available for {site}")
-        except Exception as e:
-            logging.exception(f"An error occurred while scraping {site}")
-            with open(os.path.join('crash_reports', f'{site}_crash_report.txt'), 'w') as f:
-                f.write(str(e))
-            print(f"An error occurred while scraping {site}. Check crash reports.")
+    start = time.time()
+    if config.get('parallel_websites', False) and len(selected_websites) > 1:
+        # Each site has its own hosts and quota, so they can run side by side
+        with ThreadPoolExecutor(max_workers=len(selected_websites)) as executor:
+            results = list(executor.map(lambda site: scrape_site(site, args, config), selected_websites))
+    else:
+        results = [scrape_site(site, args, config) for site in selected_websites]
+    print_summary(results, time.time() - start)
 
 if __name__ == "__main__":
     main()
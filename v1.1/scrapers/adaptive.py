@@ -0,0 +1,203 @@
+# scrapers/adaptive.py
+import asyncio
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+
+DEFAULT_MAX_LIMIT = 32
+DECREASE_FACTOR = 0.5  # On a 429 or a server error
+LATENCY_DECREASE_FACTOR = 0.9  # When responses slow down
+LATENCY_TOLERANCE = 2.0  # Times the usual latency before a response counts as slow
+LATENCY_PERCENTILE = 0.9  # The usual latency: this percentile of the recent responses
+LATENCY_WINDOW = 100  # Recent responses the percentile is taken over
+LATENCY_SAMPLES = 10  # Responses seen before latency is judged at all
+LATENCY_MARGIN = 0.05  # Seconds above the usual latency that never count as slow
+COOLDOWN = 2.0  # Seconds between two decreases, so one burst of errors counts once
+SLOT_WAIT = 1.0  # Seconds a worker thread waits for the event loop to lend it free slots
+THROUGHPUT_DECREASE_FACTOR = 0.9  # When more connections stop adding throughput
+THROUGHPUT_MIN_BYTES = 1024 * 1024  # Smaller downloads are mostly latency, and say little about throughput
+THROUGHPUT_SAMPLES = 5  # Recent downloads kept for each number of busy connections
+THROUGHPUT_MIN_SAMPLES = 3  # Downloads seen at two connection counts before they are compared
+THROUGHPUT_EFFICIENCY = 0.5  # Share of the extra connections' fair throughput they must add
+
+# Limits learned per host, shared by every client in the process and saved between runs
+_learned = {}
+_loaded = set()
+_lock = threading.Lock()
+
+class AdaptiveLimit:
+    # Concurrency limit for one host, tuned with AIMD: one more slot for every
+    # limit's worth of fast, successful responses, halved on a 429 or a 5xx,
+    # trimmed when latency climbs well above the host's usual latency, or when
+    # downloads over more connections bring in no more bytes per second in total
+    def __init__(self, host, limit, max_limit, adaptive=True):
+        self.host = host
+        self.limit = float(limit)
+        self.max_limit = max_limit
+        self.adaptive = adaptive
+        self.in_use = 0
+        self.condition = asyncio.Condition()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.throughput = {}  # Busy connections -> the host's recent total bytes per second with that many
+        self.last_decrease = 0.0
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_use < int(self.limit))
+            self.in_use += 1
+
+    async def __aexit__(self, *exc_info):
+        await self.give_back(1)
+
+    def take(self, count):
+        # Takes up to count of the free slots without waiting; runs on the event loop
+        taken = max(0, min(count, int(self.limit) - self.in_use))
+        self.in_use += taken
+        return taken
+
+    async def give_back(self, count):
+        async with self.condition:
+            self.in_use -= count
+            self.condition.notify_all()  # The limit may have grown by more than one slot
+
+    def record(self, status, latency):
+        # Runs on the event loop for every response from the host
+        if not self.adaptive:
+            return
+        now = time.monotonic()
+        if status == 429 or status >= 500:
+            self.decrease(now, DECREASE_FACTOR)
+        elif status < 400:
+            if self.slow(latency):
+                self.decrease(now, LATENCY_DECREASE_FACTOR)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        with _lock:
+            _learned[self.host] = self.limit
+
+    def record_transfer(self, size, seconds, connections=1):
+        # Runs on the event loop for every download from the host, with the bytes
+        # it received over its connections. Latency is only the time to the
+        # headers, so a full link shows up here instead: each connection gets a
+        # smaller share, and the total stays where it was with fewer of them.
+        if not self.adaptive or size < THROUGHPUT_MIN_BYTES or seconds <= 0:
+            return
+        busy = max(self.in_use, connections)
+        total = size / seconds / connections * busy
+        self.throughput.setdefault(busy, collections.deque(maxlen=THROUGHPUT_SAMPLES)).append(total)
+        if self.link_full(busy):
+            self.decrease(time.monotonic(), THROUGHPUT_DECREASE_FACTOR)
+            with _lock:
+                _learned[self.host] = self.limit
+
+    def link_full(self, busy):
+        # Compares the total at this many connections with the closest smaller
+        # number that has enough downloads, by their medians
+        fewer = [count for count, totals in self.throughput.items()
+                 if count < busy and len(totals) >= THROUGHPUT_MIN_SAMPLES]
+        if len(self.throughput[busy]) < THROUGHPUT_MIN_SAMPLES or not fewer:
+            return False
+        fewer = max(fewer)
+        gain = median(self.throughput[busy]) / median(self.throughput[fewer]) - 1
+        return gain < (busy / fewer - 1) * THROUGHPUT_EFFICIENCY
+
+    def slow(self, latency):
+        # Compared with a high percentile of the recent responses rather than the
+        # fastest, so ordinary jitter such as a cache miss doesn't count, and a
+        # lasting slowdown becomes the usual latency once it fills the window
+        slow = False
+        if len(self.latencies) >= LATENCY_SAMPLES:
+            usual = sorted(self.latencies)[int(len(self.latencies) * LATENCY_PERCENTILE)]
+            slow = latency > max(usual * LATENCY_TOLERANCE, usual + LATENCY_MARGIN)
+        self.latencies.append(latency)
+        return slow
+
+    def decrease(self, now, factor):
+        if now - self.last_decrease < COOLDOWN:
+            return
+        self.last_decrease = now
+        self.limit = max(1.0, self.limit * factor)
+        logging.info(f"Concurrency for {self.host} lowered to {int(self.limit)}")
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+class SpareSlots:
+    # Lends a download running in a worker thread the host's free slots, for
+    # the extra connections of a segmented download. Neither call blocks on
+    # the event loop for long, as the loop may be waiting for that thread.
+    # Also counts the bytes and connections the download used, for the limit's
+    # record_transfer.
+    def __init__(self, limit, loop):
+        self.limit = limit
+        self.loop = loop
+        self.received = 0
+        self.connections = 1
+        self.lock = threading.Lock()
+
+    def metered(self, throttle):
+        # Wraps a bandwidth throttle, or None, so every chunk written is counted
+        def count(size):
+            with self.lock:
+                self.received += size
+            if throttle:
+                throttle(size)
+        return count
+
+    def take(self, count):
+        result = concurrent.futures.Future()
+
+        def take_on_loop():
+            if result.set_running_or_notify_cancel():
+                result.set_result(self.limit.take(count))
+
+        try:
+            self.loop.call_soon_threadsafe(take_on_loop)
+            taken = result.result(timeout=SLOT_WAIT)
+        except RuntimeError:
+            taken = 0  # The loop is closed
+        except concurrent.futures.TimeoutError:
+            taken = 0 if result.cancel() else result.result()
+        self.connections = max(self.connections, 1 + taken)
+        return taken
+
+    def give_back(self, count):
+        if count:
+            try:
+                asyncio.run_coroutine_threadsafe(self.limit.give_back(count), self.loop)
+            except RuntimeError:
+                pass
+
+def state_path(config):
+    return config.get('concurrency_state_path') or os.path.join(config.get('metadata_path', 'metadata'), 'concurrency.json')
+
+def learned_limit(config, host, default):
+    # The limit the last run ended on for this host, so the next one starts warm
+    path = state_path(config)
+    with _lock:
+        if path not in _loaded:
+            _loaded.add(path)
+            try:
+                with open(path) as f:
+                    _learned.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+        return _learned.get(host, default)
+
+def save(config):
+    path = state_path(config)
+    with _lock:
+        state = dict(_learned)
+    if not state:
+        return
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written to a temporary file first, so parallel sites never leave half a file
+    temp_name = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_name, 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(temp_name, path)
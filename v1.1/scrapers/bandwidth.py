@@ -0,0 +1,111 @@
+# scrapers/bandwidth.py
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+
+BURST_SECONDS = 1.0
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+class ByteBucket:
+    # Token bucket of bytes that may go into debt, like ratelimit.RateLimiter:
+    # a chunk is taken at once and paid back by waiting
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate * BURST_SECONDS
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.rate * BURST_SECONDS, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, size):
+        # Takes size bytes and returns how many seconds to wait for them
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= size
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+class Bandwidth:
+    # Caps download bytes per second in total and per site. Each flow (a keyword
+    # set of a job) downloading right now gets an equal share of those caps, so
+    # a keyword set with many parallel downloads can't starve the others.
+    def __init__(self, total_rate, site_rates):
+        self.total = ByteBucket(total_rate) if total_rate else None
+        self.total_rate = total_rate
+        self.site_rates = {site: rate for site, rate in site_rates.items() if rate}
+        self.sites = {site: ByteBucket(rate) for site, rate in self.site_rates.items()}
+        self.flows = {}  # flow -> [its bucket, downloads running]
+        self.lock = threading.Lock()
+
+    def start(self, flow):
+        with self.lock:
+            if flow in self.flows:
+                self.flows[flow][1] += 1
+            else:
+                self.flows[flow] = [None, 1]
+                self.share()
+
+    def finish(self, flow):
+        with self.lock:
+            self.flows[flow][1] -= 1
+            if not self.flows[flow][1]:
+                del self.flows[flow]
+                self.share()
+
+    def share(self):
+        # Called with the lock held whenever a flow starts or ends
+        for flow, entry in self.flows.items():
+            shares = []
+            if self.total_rate:
+                shares.append(self.total_rate / len(self.flows))
+            site = flow[0]
+            if site in self.site_rates:
+                shares.append(self.site_rates[site] / sum(1 for other in self.flows if other[0] == site))
+            if not shares:
+                entry[0] = None
+            elif entry[0] is None:
+                entry[0] = ByteBucket(min(shares))
+            else:
+                entry[0].set_rate(min(shares))
+
+    def consume(self, flow, size):
+        # Called from the download threads with the size of every chunk written
+        buckets = [self.total, self.sites.get(flow[0]), self.flows[flow][0]]
+        wait = max(bucket.reserve(size) if bucket else 0 for bucket in buckets)
+        if wait > 0:
+            time.sleep(wait)
+
+def get_limiter(config):
+    # None when no cap is configured, so downloads skip the accounting entirely
+    total = config.get('bandwidth_limit_mbps', 0)
+    sites = config.get('site_bandwidth_limits_mbps', {})
+    if not total and not any(sites.values()):
+        return None
+    key = (total, tuple(sorted(sites.items())))
+    with _limiters_lock:
+        if key not in _limiters:
+            # Megabits per second, as link speeds are quoted, to bytes
+            _limiters[key] = Bandwidth(total * 125000, {site: rate * 125000 for site, rate in sites.items()})
+        return _limiters[key]
+
+@contextmanager
+def metered(config, flow):
+    # Yields the function to call with each chunk's size, or None when uncapped
+    limiter = get_limiter(config)
+    if limiter is None:
+        yield None
+        return
+    limiter.start(flow)
+    try:
+        yield partial(limiter.consume, flow)
+    finally:
+        limiter.finish(flow)
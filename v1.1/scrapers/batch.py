@@ -0,0 +1,270 @@
+# scrapers/batch.py
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+
+from scrapers import engine, jobqueue, pexels_scraper, pixabay_scraper, workqueue
+
+try:
+    import yaml
+except ImportError:  # PyYAML is optional, only YAML job files need it
+    yaml = None
+
+DEFAULT_JOB_CONCURRENCY = 4
+
+ADAPTERS = {
+    'pexels': pexels_scraper,
+    'pixabay': pixabay_scraper,
+}
+
+CONTENT_TYPES = {'1': '1', 'images': '1', 'image': '1', 'photos': '1', '2': '2', 'videos': '2', 'video': '2'}
+QUALITIES = ['HD', 'UHD', '4K', '1080P']
+FORMATS = ['16:9', '9:16']
+
+def load_jobs(path):
+    # A job file is a list of jobs, or {"defaults": {...}, "jobs": [...]}
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+            if yaml is None:
+                raise RuntimeError("YAML job files need PyYAML (pip install PyYAML)")
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+    if isinstance(data, list):
+        data = {'jobs': data}
+    defaults = data.get('defaults', {})
+    return [job_args(dict(defaults, **job), number) for number, job in enumerate(data.get('jobs', []), 1)]
+
+def as_list(value):
+    # Lists can also be written as comma separated strings
+    if isinstance(value, str):
+        return [part.strip() for part in value.split(',') if part.strip()]
+    return list(value or [])
+
+def job_args(job, number):
+    # Builds the same args the interactive prompts do
+    content_type = CONTENT_TYPES.get(str(job.get('content_type', 'images')).lower())
+    quality = str(job.get('quality', 'HD')).upper()
+    fmt = job.get('format', '16:9')
+    sites = [site.lower() for site in as_list(job.get('sites'))]
+    keyword_sets = as_list(job.get('keywords'))
+    if content_type is None:
+        raise ValueError(f"Job {number}: content_type must be images or videos")
+    if quality not in QUALITIES:
+        raise ValueError(f"Job {number}: quality must be one of {', '.join(QUALITIES)}")
+    if fmt not in FORMATS:
+        raise ValueError(f"Job {number}: format must be one of {', '.join(FORMATS)}")
+    if not sites or not keyword_sets:
+        raise ValueError(f"Job {number}: needs sites and keywords")
+    return {
+        'name': job.get('name', f"job {number}"),
+        'sites': sites,
+        'content_type': content_type,
+        'categories': as_list(job.get('categories')),
+        'styles': as_list(job.get('styles')),
+        'quality': quality,
+        'format': fmt,
+        'format_sanitized': fmt.replace(':', '-'),
+        'keyword_sets': keyword_sets,
+        'num_results': int(job.get('count', 15))
+    }
+
+def unfinished_jobs(config):
+    # Jobs a crash or a failure left unfinished, one per site, ready for run_jobs
+    return [dict(args, name=f"job {job_id}", sites=[site])
+            for job_id, site, args in jobqueue.get_queue(config).unfinished()]
+
+async def run_jobs(jobs, config):
+    # Every job runs in this one event loop. Jobs on the same site share one
+    # client, so its quota, site_concurrency and connection pool are global.
+    clients = {}
+    queue = jobqueue.get_queue(config)
+    job_slots = asyncio.Semaphore(config.get('job_concurrency', DEFAULT_JOB_CONCURRENCY))
+
+    async def run_job(job, site):
+        result = {'job': job['name'], 'site': site, 'keywords': job['keyword_sets'],
+                  'status': 'ok', 'downloaded': {}, 'elapsed': 0.0}
+        adapter = ADAPTERS.get(site)
+        if adapter is None:
+            logging.warning(f"No scraper available for {site}")
+            result['status'] = 'no scraper'
+            return result
+        if not config['api_keys'].get(site):
+            logging.error(f"{adapter.SITE_NAME} API key is missing.")
+            result['status'] = 'no api key'
+            return result
+
+        async with job_slots:
+            start = time.time()
+            if site not in clients:
+                clients[site] = engine.Client(config, adapter)
+            job_id = queue.add(site, job)
+            queue.set_status(job_id, 'running')
+            try:
+                result['downloaded'] = await engine.run(adapter, job, config, clients[site], job_id)
+                queue.set_status(job_id, 'done')
+            except engine.IncompleteRun as e:
+                # Left failed, so resume picks it up from its checkpoints
+                logging.error(f"{job['name']} on {site}: {e}")
+                result['status'] = 'failed'
+                result['error'] = str(e)
+                result['downloaded'] = e.results
+                queue.set_status(job_id, 'failed', str(e))
+            except Exception as e:
+                logging.exception(f"{job['name']} failed on {site}")
+                result['status'] = 'failed'
+                result['error'] = str(e)
+                queue.set_status(job_id, 'failed', str(e))
+            result['elapsed'] = round(time.time() - start, 2)
+        return result
+
+    start = time.time()
+    try:
+        results = await asyncio.gather(*(run_job(job, site) for job in jobs for site in job['sites']))
+    finally:
+        for client in clients.values():
+            client.close()
+    return {
+        'status': 'failed' if any(result['status'] in ('failed', 'no api key') for result in results) else 'ok',
+        'jobs': results,
+        'downloaded': sum(sum(result['downloaded'].values()) for result in results),
+        'elapsed': round(time.time() - start, 2)
+    }
+
+def plan_units(jobs, pages_per_unit=workqueue.DEFAULT_PAGES_PER_UNIT):
+    # Splits jobs into (site, keyword set, page range) units for the work queue.
+    # Each unit is after its share of num_results, as many as its pages hold.
+    units = []
+    for job in jobs:
+        for site in job['sites']:
+            adapter = ADAPTERS.get(site)
+            if adapter is None:
+                logging.warning(f"No scraper available for {site}")
+                continue
+            pages = math.ceil(job['num_results'] / adapter.PER_PAGE)
+            for keyword_set in job['keyword_sets']:
+                for first_page in range(1, pages + 1, pages_per_unit):
+                    last_page = min(first_page + pages_per_unit - 1, pages)
+                    num_results = min(job['num_results'] - (first_page - 1) * adapter.PER_PAGE,
+                                      (last_page - first_page + 1) * adapter.PER_PAGE)
+                    args = dict(job, keyword_sets=[keyword_set], num_results=num_results,
+                                first_page=first_page, last_page=last_page)
+                    units.append((site, keyword_set, first_page, last_page, args))
+    return units
+
+async def call(func, *args):
+    # The work queue sits on a shared drive, so its calls stay off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+async def run_worker(config, worker_id):
+    # Claims work units until none are left. Any number of workers, on this
+    # machine or on others sharing database_path, can run at the same time.
+    config = dict(config, worker_id=worker_id)  # Items are claimed under this name, see dedupe
+    work = workqueue.get_queue(config)
+    jobs = jobqueue.get_queue(config)
+    lease = config.get('work_lease', workqueue.DEFAULT_LEASE)
+    clients = {}
+    results = []
+
+    async def keep_lease(unit_id, job_id, keyword_set, task):
+        # Renews the lease with the unit's progress. Returns True, after stopping
+        # the unit, if the lease ran out and another worker has taken the unit over.
+        while True:
+            await asyncio.sleep(lease / 3)
+            checkpoint = await call(jobs.load_checkpoint, job_id, keyword_set)
+            if not await call(work.renew, unit_id, worker_id, lease, checkpoint['files_saved'] if checkpoint else 0):
+                logging.warning(f"Lost the lease on work unit {unit_id}, stopping it")
+                task.cancel()
+                return True
+
+    async def follow_up(unit_id, job_id, args, files_saved):
+        # Skipped renditions, filters and duplicates can leave a unit short of its
+        # share once it has been through its results. The shortfall is queued as
+        # a unit for more pages, unless the search ran out of results or an
+        # earlier follow-up found nothing.
+        shortfall = args['num_results'] - files_saved
+        if shortfall <= 0 or (args.get('follow_up') and not files_saved):
+            return
+        checkpoint = await call(jobs.load_checkpoint, job_id, args['keyword_sets'][0])
+        if not checkpoint:
+            return
+        if checkpoint['downloaded'] < args['num_results'] and checkpoint['page'] <= args['last_page']:
+            return  # Stopped on an empty page: the search has no more results
+        new_id, first_page, last_page = await call(work.add_follow_up, unit_id, checkpoint['page'], shortfall)
+        logging.info(f"Work unit {unit_id} saved {files_saved} of {args['num_results']} files, "
+                     f"queued unit {new_id} for pages {first_page}-{last_page}")
+
+    async def work_loop():
+        while True:
+            unit = await call(work.claim, worker_id, lease)
+            if unit is None:
+                if 'leased' not in await call(work.counts):
+                    return
+                await asyncio.sleep(min(lease, 30))  # Units leased to others may still come back
+                continue
+
+            unit_id, site, args = unit
+            keyword_set = args['keyword_sets'][0]
+            result = {'unit': unit_id, 'site': site, 'keywords': keyword_set,
+                      'pages': [args['first_page'], args['last_page']], 'status': 'ok', 'downloaded': 0}
+            adapter = ADAPTERS.get(site)
+            if adapter is None or not config['api_keys'].get(site):
+                result['status'] = 'no scraper' if adapter is None else 'no api key'
+                await call(work.finish, unit_id, worker_id, 0, result['status'])
+                results.append(result)
+                continue
+
+            start = time.time()
+            if site not in clients:
+                clients[site] = engine.Client(config, adapter)
+            job_id = await call(jobs.add, site, args)
+            await call(jobs.set_status, job_id, 'running')
+            task = asyncio.ensure_future(engine.run(adapter, args, config, clients[site], job_id))
+            heartbeat = asyncio.ensure_future(keep_lease(unit_id, job_id, keyword_set, task))
+            try:
+                result['downloaded'] = sum((await task).values())
+                # Queued before the unit is finished, so no worker sees an empty queue in between
+                await follow_up(unit_id, job_id, args, result['downloaded'])
+                await call(work.finish, unit_id, worker_id, result['downloaded'])
+                await call(jobs.set_status, job_id, 'done')
+            except asyncio.CancelledError:
+                if not (heartbeat.done() and heartbeat.result()):
+                    raise
+                result['status'] = 'lost lease'
+                await call(jobs.set_status, job_id, 'failed', 'lost lease')
+            except engine.IncompleteRun as e:
+                # The unit goes back to the queue and its next worker resumes the checkpoint
+                logging.error(f"Work unit {unit_id} on {site}: {e}")
+                result['status'] = 'failed'
+                result['error'] = str(e)
+                result['downloaded'] = sum(e.results.values())
+                await call(work.finish, unit_id, worker_id, result['downloaded'], str(e))
+                await call(jobs.set_status, job_id, 'failed', str(e))
+            except Exception as e:
+                logging.exception(f"Work unit {unit_id} failed on {site}")
+                result['status'] = 'failed'
+                result['error'] = str(e)
+                await call(work.finish, unit_id, worker_id, 0, str(e))
+                await call(jobs.set_status, job_id, 'failed', str(e))
+            finally:
+                heartbeat.cancel()
+            result['elapsed'] = round(time.time() - start, 2)
+            results.append(result)
+
+    start = time.time()
+    try:
+        await asyncio.gather(*(work_loop() for _ in range(config.get('job_concurrency', DEFAULT_JOB_CONCURRENCY))))
+    finally:
+        for client in clients.values():
+            client.close()
+    return {
+        'worker': worker_id,
+        'status': 'failed' if any(result['status'] != 'ok' for result in results) else 'ok',
+        'units': results,
+        'downloaded': sum(result['downloaded'] for result in results),
+        'elapsed': round(time.time() - start, 2),
+        'queue': work.counts()
+    }
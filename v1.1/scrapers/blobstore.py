@@ -0,0 +1,136 @@
+# scrapers/blobstore.py
+import logging
+import os
+import shutil
+
+from scrapers import catalog, downloader
+
+DEFAULT_LINK_METHOD = 'hardlink'
+
+# The directory hierarchy the scrapers save into, used as the default view
+DEFAULT_LAYOUT = os.path.join('{website}', '{keyword_dir}', '{categories}', '{styles}',
+                              '{content_type}', '{quality}', '{format_sanitized}')
+
+def enabled(config):
+    return config.get('blob_store', False)
+
+def store_path(config):
+    return config.get('blob_store_path') or os.path.join(config['database_path'], 'blobs')
+
+def blob_path(config, sha256):
+    # Fanned out on the first two hex digits to keep directories small
+    return os.path.join(store_path(config), sha256[:2], sha256)
+
+def has_blob(config, sha256):
+    return bool(sha256) and os.path.exists(blob_path(config, sha256))
+
+def store_file(config, file_name, sha256):
+    # Moves a freshly downloaded file into the store, unless the same bytes are
+    # already there, and puts a link to the blob back in its place
+    blob = blob_path(config, sha256)
+    if os.path.exists(blob):
+        os.remove(file_name)
+    else:
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        shutil.move(file_name, blob)
+    link_file(blob, file_name, config.get('dedupe_link', DEFAULT_LINK_METHOD))
+    return blob
+
+def link_file(source, target, method):
+    # Links go to a temporary name first, so target is replaced in one step
+    temp_name = target + '.link'
+    if os.path.lexists(temp_name):
+        os.remove(temp_name)
+    methods = {'reflink': [reflink, os.link, symlink], 'hardlink': [os.link, symlink],
+               'symlink': [symlink]}.get(method, [])
+    for make_link in methods:
+        try:
+            make_link(source, temp_name)
+            break
+        except (OSError, NotImplementedError):
+            continue
+    else:
+        shutil.copyfile(source, temp_name)  # Different volume or no link support
+    os.replace(temp_name, target)
+
+def symlink(source, target):
+    os.symlink(os.path.abspath(source), target)
+
+def reflink(source, target):
+    # Copy-on-write clone (Btrfs, XFS); only available through ioctl on Linux
+    try:
+        import fcntl
+    except ImportError:
+        raise NotImplementedError("reflink needs Linux")
+    FICLONE = 0x40049409
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(target)
+            raise
+
+def view_path(metadata, layout):
+    categories = '_'.join(metadata['categories']) if metadata['categories'] else 'All'
+    styles = '_'.join(metadata['styles']) if metadata['styles'] else 'All'
+    fields = dict(
+        metadata,
+        keyword_dir=metadata['keywords'].replace(' ', '_'),
+        categories=categories,
+        styles=styles,
+        format_sanitized=metadata['format'].replace(':', '-')
+    )
+    file_name = os.path.basename(metadata['file_name'])
+    return os.path.join(layout.format(**fields), file_name)
+
+def build_view(config, output_path, layout=DEFAULT_LAYOUT, website=None, keyword_sets=None):
+    # Materialises a directory tree of links to the blobs, laid out by any of
+    # the metadata fields, without copying any bytes
+    method = config.get('dedupe_link', DEFAULT_LINK_METHOD)
+    sql = catalog.SELECT_MEDIA + " WHERE sha256 IS NOT NULL"
+    params = []
+    if website:
+        sql += " AND website = ?"
+        params.append(website)
+    if keyword_sets:
+        sql += f" AND keywords IN ({','.join('?' * len(keyword_sets))})"
+        params.extend(keyword_sets)
+
+    linked = 0
+    missing = 0
+    for row in catalog.get_catalog(config).query(sql, params):
+        metadata = catalog.from_row(row)
+        blob = blob_path(config, metadata['sha256'])
+        if not os.path.exists(blob):
+            missing += 1
+            continue
+        target = os.path.join(output_path, view_path(metadata, layout))
+        if os.path.exists(target):
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        link_file(blob, target, method)
+        linked += 1
+    if missing:
+        logging.warning(f"{missing} catalog entries have no blob in {store_path(config)}")
+    logging.info(f"View {output_path}: linked {linked} files")
+    return linked
+
+def import_library(config):
+    # Moves files saved before the store existed into it, leaving links behind
+    catalog_db = catalog.get_catalog(config)
+    catalog_db.flush()
+    stored = 0
+    for file_name, sha256 in catalog_db.query("SELECT DISTINCT file_name, sha256 FROM media"):
+        if not os.path.isfile(file_name) or os.path.islink(file_name):
+            continue
+        if not sha256:
+            sha256 = downloader.file_digest(file_name)['sha256']
+            catalog_db.set_hash(file_name, sha256)
+        blob = blob_path(config, sha256)
+        if os.path.exists(blob) and os.path.samefile(file_name, blob):
+            continue  # Already a hard link to its blob
+        store_file(config, file_name, sha256)
+        stored += 1
+    logging.info(f"Moved {stored} files into the blob store")
+    return stored
@@ -0,0 +1,409 @@
+# scrapers/catalog.py
+import atexit
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+DEFAULT_BATCH_SIZE = 200
+WRITE_ATTEMPTS = 5
+
+# Columns of the metadata entries documented in "Database documentation.md".
+# Anything else an adapter adds (original_url, page_url, ...) goes to extra.
+COLUMNS = ['file_name', 'file_url', 'website', 'keywords', 'categories', 'styles',
+           'content_type', 'quality', 'format', 'id', 'sha256', 'phash', 'size']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    website TEXT NOT NULL,
+    item_id NOT NULL,
+    file_name TEXT NOT NULL,
+    file_url TEXT,
+    keywords TEXT,
+    categories TEXT,
+    styles TEXT,
+    content_type TEXT,
+    quality TEXT,
+    format TEXT,
+    extra TEXT,
+    added_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    sha256 TEXT,
+    phash TEXT,
+    size INTEGER,
+    UNIQUE (website, item_id, file_name)
+);
+CREATE INDEX IF NOT EXISTS media_website_id ON media (website, item_id);
+CREATE INDEX IF NOT EXISTS media_keywords ON media (keywords);
+CREATE INDEX IF NOT EXISTS media_file_name ON media (file_name);
+CREATE TABLE IF NOT EXISTS harvested (
+    website TEXT NOT NULL,
+    query TEXT NOT NULL,
+    item_id NOT NULL,
+    harvested_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (website, query, item_id)
+);
+CREATE TABLE IF NOT EXISTS skipped (
+    website TEXT NOT NULL,
+    item_id NOT NULL,
+    reason TEXT NOT NULL,
+    duplicate_of TEXT,
+    skipped_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (website, item_id)
+);
+"""
+
+# Columns added after the first release of the catalog
+MIGRATIONS = {
+    'sha256': "ALTER TABLE media ADD COLUMN sha256 TEXT",
+    'phash': "ALTER TABLE media ADD COLUMN phash TEXT",
+    'size': "ALTER TABLE media ADD COLUMN size INTEGER",
+}
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS media_sha256 ON media (sha256);
+"""
+
+UPSERT = """
+INSERT INTO media (website, item_id, file_name, file_url, keywords, categories, styles,
+                   content_type, quality, format, extra, sha256, phash, size)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (website, item_id, file_name) DO UPDATE SET
+    file_url = excluded.file_url,
+    extra = excluded.extra,
+    sha256 = COALESCE(excluded.sha256, media.sha256),
+    phash = COALESCE(excluded.phash, media.phash),
+    size = COALESCE(excluded.size, media.size)
+"""
+
+# Column order expected by from_row
+SELECT_MEDIA = """
+SELECT website, item_id, file_name, file_url, keywords, categories, styles,
+       content_type, quality, format, extra, sha256, phash, size FROM media
+"""
+
+# One catalog per database file, shared by every site and run in the process
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def connect(path, wal=True):
+    # WAL does not work over network file systems; a catalog on a shared drive
+    # keeps SQLite's rollback journal instead
+    connection = sqlite3.connect(path, timeout=30)
+    if wal:
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+    else:
+        connection.execute('PRAGMA journal_mode=DELETE')
+    return connection
+
+class Catalog:
+    # Download workers hand records to add(); a single writer thread commits
+    # them in batches, so no worker ever waits on a SQLite transaction
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, wal=True):
+        self.path = path
+        self.batch_size = batch_size
+        self.wal = wal
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = connect(path, wal)
+        connection.executescript(SCHEMA)
+        existing_columns = {row[1] for row in connection.execute("PRAGMA table_info(media)")}
+        for column, statement in MIGRATIONS.items():
+            if column not in existing_columns:
+                connection.execute(statement)
+        connection.executescript(INDEXES)
+        connection.close()
+        # Records the writer could not commit yet, retried with the next batch,
+        # and the number it had to give up on since the last flush()
+        self.unwritten = []
+        self.rejected = 0
+        self.error = None
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, name='catalog-writer', daemon=True)
+        self.writer.start()
+
+    def add(self, metadata_list):
+        for metadata in metadata_list:
+            self.queue.put(to_row(metadata))
+
+    def flush(self):
+        # Blocks until everything added so far is committed, and raises if
+        # some of it could not be
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+        if self.unwritten or self.rejected:
+            lost = len(self.unwritten) + self.rejected
+            self.rejected = 0
+            raise RuntimeError(f"{lost} records could not be written to the catalog: {self.error}")
+
+    def close(self):
+        try:
+            self.flush()
+        except RuntimeError as e:
+            logging.error(str(e))
+        self.queue.put(None)
+        self.writer.join()
+
+    def _write_loop(self):
+        connection = connect(self.path, self.wal)
+        running = True
+        while running:
+            rows = []
+            waiters = []
+            entry = self.queue.get()
+            while True:
+                if entry is None:
+                    running = False
+                elif isinstance(entry, threading.Event):
+                    waiters.append(entry)
+                else:
+                    rows.append(entry)
+                if len(rows) >= self.batch_size or not running:
+                    break
+                try:
+                    entry = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if rows or self.unwritten:
+                self._write(connection, self.unwritten + rows)
+            for waiter in waiters:
+                waiter.set()
+        connection.close()
+
+    def _write(self, connection, rows):
+        # Another connection, or another machine, can hold the database
+        # locked past the timeout, so a failed batch is tried again
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                with connection:
+                    connection.executemany(UPSERT, rows)
+                self.unwritten = []
+                self.error = None
+                return
+            except sqlite3.OperationalError as e:
+                self.error = e
+                logging.warning(f"Failed to write {len(rows)} records to the catalog, attempt {attempt + 1}: {e}")
+                if attempt + 1 < WRITE_ATTEMPTS:
+                    time.sleep(2 ** attempt)
+            except sqlite3.Error as e:
+                # A record the schema refuses would fail every batch, so the
+                # others are written one at a time and it is given up on
+                self.error = e
+                self.unwritten = []
+                for row in rows:
+                    try:
+                        with connection:
+                            connection.execute(UPSERT, row)
+                    except sqlite3.Error as row_error:
+                        logging.error(f"Failed to write the catalog record of {row[2]}: {row_error}")
+                        self.rejected += 1
+                return
+        # Kept for the next batch; flush() reports them meanwhile
+        self.unwritten = rows
+        logging.error(f"Could not write {len(rows)} records to the catalog: {self.error}")
+
+    def query(self, sql, params=()):
+        # WAL lets readers run next to the writer thread; with the rollback
+        # journal they wait out its commits
+        connection = connect(self.path, self.wal)
+        try:
+            return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+    def known_files(self, website, content_type, items):
+        # (file_name, item_id, sha256) of every copy saved for the (item_id, file_url)
+        # pairs in items, of that content type and from that same file_url
+        if not items:
+            return []
+        rows = self.query(
+            f"SELECT file_name, item_id, file_url, sha256 FROM media WHERE website = ? AND content_type = ? "
+            f"AND item_id IN ({','.join('?' * len(items))})",
+            [website, content_type] + [item_id for item_id, _ in items]
+        )
+        wanted = set(items)
+        return [(file_name, item_id, sha256) for file_name, item_id, file_url, sha256 in rows
+                if (item_id, file_url) in wanted]
+
+    def set_hash(self, file_name, sha256):
+        connection = connect(self.path, self.wal)
+        try:
+            with connection:
+                connection.execute("UPDATE media SET sha256 = ? WHERE file_name = ?", (sha256, file_name))
+        finally:
+            connection.close()
+
+    def library_files(self, website=None):
+        # (file_name, sha256, size) of every file in the catalog, for verify
+        sql = "SELECT file_name, MAX(sha256), MAX(size) FROM media"
+        params = []
+        if website:
+            sql += " WHERE website = ?"
+            params.append(website)
+        return self.query(sql + " GROUP BY file_name", params)
+
+    def files_with_hash(self, sha256):
+        return [row[0] for row in self.query("SELECT file_name FROM media WHERE sha256 = ?", (sha256,))]
+
+    def harvested_ids(self, website, query, item_ids):
+        # The ids among item_ids an incremental crawl of this query has already been through
+        if not item_ids:
+            return set()
+        rows = self.query(
+            f"SELECT item_id FROM harvested WHERE website = ? AND query = ? "
+            f"AND item_id IN ({','.join('?' * len(item_ids))})",
+            [website, query] + list(item_ids)
+        )
+        return {row[0] for row in rows}
+
+    def mark_harvested(self, website, query, item_ids):
+        connection = connect(self.path, self.wal)
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO harvested (website, query, item_id) VALUES (?, ?, ?)",
+                    [(website, query, item_id) for item_id in item_ids]
+                )
+        finally:
+            connection.close()
+
+    def skipped_ids(self, website, item_ids):
+        # The ids among item_ids that were downloaded once and then thrown away
+        if not item_ids:
+            return set()
+        rows = self.query(
+            f"SELECT item_id FROM skipped WHERE website = ? AND item_id IN ({','.join('?' * len(item_ids))})",
+            [website] + list(item_ids)
+        )
+        return {row[0] for row in rows}
+
+    def mark_skipped(self, website, item_id, reason, duplicate_of=None):
+        connection = connect(self.path, self.wal)
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO skipped (website, item_id, reason, duplicate_of) VALUES (?, ?, ?, ?)",
+                    (website, item_id, reason, duplicate_of)
+                )
+        finally:
+            connection.close()
+
+    def keywords_for(self, website, item_id):
+        # Every keyword set that has reached this item
+        rows = self.query("SELECT DISTINCT keywords FROM media WHERE website = ? AND item_id = ?", (website, item_id))
+        return [row[0] for row in rows]
+
+def to_row(metadata):
+    extra = {key: value for key, value in metadata.items() if key not in COLUMNS}
+    keywords = metadata['keywords']
+    if isinstance(keywords, list):
+        keywords = ' '.join(keywords)  # Files from before keyword sets stored a list
+    return (
+        metadata['website'], metadata['id'], metadata['file_name'], metadata['file_url'], keywords,
+        json.dumps(metadata.get('categories', [])), json.dumps(metadata.get('styles', [])),
+        metadata['content_type'], metadata['quality'], metadata['format'], json.dumps(extra),
+        metadata.get('sha256'), metadata.get('phash'), metadata.get('size')
+    )
+
+def from_row(row):
+    (website, item_id, file_name, file_url, keywords, categories, styles,
+     content_type, quality, fmt, extra, sha256, phash, size) = row
+    metadata = {
+        'file_name': file_name,
+        'file_url': file_url,
+        'website': website,
+        'keywords': keywords,
+        'categories': json.loads(categories),
+        'styles': json.loads(styles),
+        'content_type': content_type,
+        'quality': quality,
+        'format': fmt,
+        'id': item_id
+    }
+    if sha256:
+        metadata['sha256'] = sha256
+    if phash:
+        metadata['phash'] = phash
+    if size is not None:
+        metadata['size'] = size
+    metadata.update(json.loads(extra or '{}'))
+    return metadata
+
+def get_catalog(config):
+    path = config.get('catalog_path') or os.path.join(config.get('metadata_path', 'metadata'), 'catalog.db')
+    with _catalogs_lock:
+        if path not in _catalogs:
+            _catalogs[path] = Catalog(path, config.get('catalog_batch_size', DEFAULT_BATCH_SIZE),
+                                      not config.get('network_databases', False))
+        return _catalogs[path]
+
+@atexit.register
+def close_all():
+    with _catalogs_lock:
+        for catalog in _catalogs.values():
+            catalog.close()
+        _catalogs.clear()
+
+def metadata_file_name(metadata):
+    # Same layout as the JSON files the scrapers used to append to
+    keyword_dir = metadata['keywords'].replace(' ', '_')
+    categories = '_'.join(metadata['categories']) if metadata['categories'] else 'All'
+    styles = '_'.join(metadata['styles']) if metadata['styles'] else 'All'
+    fmt_sanitized = metadata['format'].replace(':', '-')
+    return (f"{metadata['website']}_{keyword_dir}_{categories}_{styles}_"
+            f"{metadata['content_type']}_{metadata['quality']}_{fmt_sanitized}.json")
+
+def export_json(config, output_path=None, website=None, keyword_sets=None):
+    # Writes one valid JSON list per metadata file, replacing the old file
+    output_path = output_path or config.get('metadata_path', 'metadata')
+    catalog = get_catalog(config)
+    catalog.flush()
+
+    sql = SELECT_MEDIA
+    conditions = []
+    params = []
+    if website:
+        conditions.append("website = ?")
+        params.append(website)
+    if keyword_sets:
+        conditions.append(f"keywords IN ({','.join('?' * len(keyword_sets))})")
+        params.extend(keyword_sets)
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY rowid"
+
+    files = {}
+    for row in catalog.query(sql, params):
+        metadata = from_row(row)
+        files.setdefault(metadata_file_name(metadata), []).append(metadata)
+
+    os.makedirs(output_path, exist_ok=True)
+    for name, metadata_list in files.items():
+        with open(os.path.join(output_path, name), 'w') as f:
+            json.dump(metadata_list, f, indent=4)
+    logging.info(f"Exported {len(files)} metadata files to {output_path}")
+    return len(files)
+
+def import_json(config, path):
+    # Loads metadata files written before the catalog existed, including the
+    # ones that hold several JSON lists appended one after another
+    decoder = json.JSONDecoder()
+    catalog = get_catalog(config)
+    count = 0
+    with open(path) as f:
+        text = f.read()
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position >= len(text):
+            break
+        metadata_list, position = decoder.raw_decode(text, position)
+        catalog.add(metadata_list)
+        count += len(metadata_list)
+    catalog.flush()
+    return count
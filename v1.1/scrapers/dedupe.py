@@ -0,0 +1,164 @@
+# scrapers/dedupe.py
+import asyncio
+import logging
+import os
+import threading
+import time
+from functools import partial
+
+from scrapers import bandwidth, blobstore, catalog, downloader, workqueue
+
+# Files saved during this process, so parallel keyword sets and sites see
+# each other's downloads before the catalog writer has committed them.
+# An item is only the same item in the same rendition: a Pexels video can
+# share its id with a photo, and the rendition saved depends on the quality.
+# _by_id is keyed on (website, content_type, item_id, file_url) for that.
+_by_id = {}
+_by_hash = {}
+_lock = threading.Lock()
+
+def remember(website, content_type, item_id, file_url, file_name, sha256):
+    with _lock:
+        _by_id[(website, content_type, item_id, file_url)] = (file_name, sha256)
+        if sha256:
+            _by_hash.setdefault(sha256, file_name)
+
+def discard(config, website, content_type, item_id, file_url, file_name, sha256):
+    # Removes a saved file that isn't wanted after all, and its blob once
+    # nothing else links to it
+    key = (website, content_type, item_id, file_url)
+    with _lock:
+        if _by_id.get(key, (None,))[0] == file_name:
+            del _by_id[key]
+        if _by_hash.get(sha256) == file_name:
+            del _by_hash[sha256]
+        shared = any(name != file_name and saved_hash == sha256 for name, saved_hash in _by_id.values())
+    os.remove(file_name)
+    if shared or not sha256 or not blobstore.enabled(config):
+        return
+    blob = blobstore.blob_path(config, sha256)
+    if not os.path.exists(blob):
+        return
+    # Hard links show in the link count; symbolic links only in the catalog
+    if os.stat(blob).st_nlink > 1:
+        return
+    if any(os.path.lexists(name) for name in catalog.get_catalog(config).files_with_hash(sha256)):
+        return
+    os.remove(blob)
+    logging.info(f"Removed blob {blob}, nothing links to it any more")
+
+def find_known(config, website, content_type, items):
+    # Returns {item_id: [(file_name, sha256), ...]} for the (item_id, file_url)
+    # pairs in items that were saved before from that same file_url
+    known = {}
+    for file_name, item_id, sha256 in catalog.get_catalog(config).known_files(website, content_type, items):
+        known.setdefault(item_id, []).append((file_name, sha256))
+    with _lock:
+        for item_id, file_url in items:
+            if (website, content_type, item_id, file_url) in _by_id:
+                known.setdefault(item_id, []).append(_by_id[(website, content_type, item_id, file_url)])
+    return known
+
+def find_by_hash(config, sha256):
+    with _lock:
+        if sha256 in _by_hash and os.path.exists(_by_hash[sha256]):
+            return _by_hash[sha256]
+    for file_name in catalog.get_catalog(config).files_with_hash(sha256):
+        if os.path.exists(file_name):
+            return file_name
+    return None
+
+async def wait_for_owner(client, config, website, content_type, item_id, file_url, file_name):
+    # In worker mode the first node to reach an item downloads it, and the others
+    # link to its file once it is there. Returns that file, or None to download here.
+    # A coroutine, called before taking any download slot, so waiting holds
+    # neither a connection nor a thread.
+    queue = workqueue.get_queue(config)
+    worker = config['worker_id']
+    item = (website, content_type, item_id, file_url)
+    owner_file = await client.call(queue.claim_item, *item, worker, file_name)
+    deadline = time.time() + config.get('work_lease', workqueue.DEFAULT_LEASE)
+    while owner_file is not None:
+        if await client.call(os.path.exists, owner_file):
+            return owner_file
+        if time.time() >= deadline:
+            logging.warning(f"{owner_file} never appeared, downloading item {item_id} here instead")
+            await client.call(partial(queue.claim_item, *item, worker, file_name, take_over=True))
+            return None
+        await asyncio.sleep(1)
+        # The owner gives the item up if its download fails; then it is claimed here
+        owner = await client.call(queue.item_owner, *item)
+        if owner is None:
+            owner_file = await client.call(queue.claim_item, *item, worker, file_name)
+        else:
+            owner_file = None if owner[0] == worker else owner[1]
+    return None
+
+def fetch_file(url, file_name, website, content_type, item_id, known, session, config, flow=None, owner_file=None,
+               spare_slots=None):
+    # Saves one item to file_name, reusing bytes we already have where possible.
+    # Returns the metadata fields to record, or False if nothing could be saved.
+    # known holds the copies saved before from the same url, from find_known;
+    # flow is the (website, job, keyword set) the download's bandwidth is shared by;
+    # owner_file is the copy another worker saved, from wait_for_owner;
+    # spare_slots lends a segmented download the host's free slots and counts its bytes.
+    method = config.get('dedupe_link', blobstore.DEFAULT_LINK_METHOD)
+    dedupe = config.get('dedupe', True)
+
+    if os.path.exists(file_name):
+        # A hash was only recorded for a file this code downloaded whole; older
+        # files have their size checked with the server first
+        sha256 = next((sha256 for name, sha256 in known if name == file_name and sha256), None)
+        if sha256:
+            logging.info(f"File already exists: {file_name}")
+            result = {'sha256': sha256, 'size': os.path.getsize(file_name)}
+        else:
+            result = downloader.existing_file(url, file_name, session)
+        if result:
+            remember(website, content_type, item_id, url, file_name, result['sha256'])
+            return result
+
+    sources = [(name, sha256) for name, sha256 in known if os.path.exists(name)]
+    if dedupe and sources:
+        source, sha256 = sources[0]
+        if blobstore.has_blob(config, sha256):
+            source = blobstore.blob_path(config, sha256)
+        try:
+            blobstore.link_file(source, file_name, method)
+            logging.info(f"Linked {file_name} to {source}")
+            sha256 = sha256 or downloader.file_digest(file_name)['sha256']
+            remember(website, content_type, item_id, url, file_name, sha256)
+            return {'sha256': sha256, 'size': os.path.getsize(file_name), 'linked_from': source}
+        except OSError as e:
+            logging.error(f"Failed to link {file_name} to {source}, downloading it instead: {e}")
+
+    if owner_file and os.path.abspath(owner_file) != os.path.abspath(file_name):
+        blobstore.link_file(owner_file, file_name, method)
+        logging.info(f"Linked {file_name} to {owner_file}, downloaded by another worker")
+        sha256 = downloader.file_digest(file_name)['sha256']
+        remember(website, content_type, item_id, url, file_name, sha256)
+        return {'sha256': sha256, 'size': os.path.getsize(file_name), 'linked_from': owner_file}
+
+    with bandwidth.metered(config, flow or (website,)) as throttle:
+        if spare_slots:
+            throttle = spare_slots.metered(throttle)
+        result = downloader.download_file(url, file_name, session, config, throttle, spare_slots)
+    if not result:
+        if config.get('worker_id'):
+            workqueue.get_queue(config).release_item(website, content_type, item_id, url, config['worker_id'])
+        return False
+
+    # Hashed while it was written, the file isn't read again
+    sha256 = result['sha256']
+    if blobstore.enabled(config):
+        # Identical bytes end up as one blob, whichever item they came from
+        blobstore.store_file(config, file_name, sha256)
+    elif dedupe:
+        # The same bytes can come back under another id, or from another site
+        source = find_by_hash(config, sha256)
+        if source and os.path.abspath(source) != os.path.abspath(file_name):
+            blobstore.link_file(source, file_name, method)
+            logging.info(f"{file_name} has the same content as {source}, linked it instead")
+            result['linked_from'] = source
+    remember(website, content_type, item_id, url, file_name, sha256)
+    return result
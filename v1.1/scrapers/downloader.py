@@ -0,0 +1,436 @@
+# scrapers/downloader.py
+import hashlib
+import os
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_SEGMENT_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_SEGMENTS = 4
+DEFAULT_BUFFER_SIZE = 256 * 1024
+DEFAULT_FSYNC = 'off'
+DEFAULT_FSYNC_BATCH = 64
+PROGRESS_BYTES = 8 * 1024 * 1024  # Written to a range between two saves of its .segments file
+
+class RemoteFileChanged(Exception):
+    # The server answered a resume with bytes of another version of the file
+    pass
+
+# Files renamed into place but not yet synced, with fsync set to batch
+_unsynced = []
+_unsynced_lock = threading.Lock()
+
+def download_file(url, file_name, session, config, throttle=None, spare_slots=None, restarted=False):
+    # Returns {'sha256', 'size'} of the saved file, or False if it couldn't be saved.
+    # throttle, if given, is called with the size of every chunk written (see bandwidth).
+    # spare_slots (see adaptive.SpareSlots) limits the connections of a segmented download.
+    # restarted is set on the one retry from scratch after a mismatched resume.
+    try:
+        if os.path.exists(file_name):
+            result = existing_file(url, file_name, session)
+            if result:
+                return result
+
+        # Bytes go to a .part file that is only renamed once complete, so an
+        # interrupted download is resumed next time instead of being kept
+        part_name = file_name + '.part'
+        # A .part file is only resumed from the URL that started it, since the
+        # rendition saved under a file name can change between runs
+        source = load_source(part_name)
+        if (os.path.exists(part_name) or os.path.exists(part_name + '.segments')) and (source or {}).get('url') != url:
+            logging.info(f"Restarting {file_name}: its .part file is from {(source or {}).get('url', 'an unknown URL')}")
+            discard_part(part_name)
+        if os.path.exists(part_name + '.segments'):
+            return download_segmented(url, file_name, part_name, None, session, config, throttle, spare_slots,
+                                      restarted)
+
+        offset = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+        headers = resume_headers(source, offset) if offset else None
+
+        # Closing the response hands the connection back to the session pool
+        with session.get(url, stream=True, headers=headers) as response:
+            if response.status_code == 416:
+                return finish_range_not_satisfiable(response, part_name, file_name, offset, config)
+            if response.status_code == 206 and range_start(response) != offset:
+                response.close()
+                error = RemoteFileChanged(f"asked for byte {offset} on, got {response.headers.get('Content-Range')}")
+                return restart(error, url, file_name, part_name, session, config, throttle, spare_slots, restarted)
+            if response.status_code == 206:
+                mode = 'ab'
+                logging.info(f"Resuming {file_name} from byte {offset}")
+                digest = file_digest(part_name, offset, digest=True)  # Only the bytes already there
+            elif response.status_code == 200:
+                mode = 'wb'  # The server ignored the range, or the file changed since, start over
+                offset = 0
+                digest = hashlib.sha256()
+                save_source(part_name, url, response)
+            else:
+                logging.error(f"Failed to download {url}: Status code {response.status_code}")
+                return False
+
+            # A compressed body is decoded on the way in, so its length won't match
+            expected_size = None if response.headers.get('Content-Encoding') else response.headers.get('Content-Length')
+            if mode == 'wb' and should_segment(response, expected_size, config):
+                total_size = int(expected_size)
+            else:
+                total_size = None
+                written = write_response(response, part_name, mode, offset, expected_size, config, throttle, digest)
+
+        if total_size is not None:
+            return download_segmented(url, file_name, part_name, total_size, session, config, throttle, spare_slots,
+                                      restarted)
+
+        if expected_size is not None and written != int(expected_size):
+            logging.error(f"Incomplete download of {url}: {written} of {expected_size} bytes, will resume next run")
+            return False
+
+        finish_file(part_name, file_name, config)
+        logging.info(f"Downloaded {file_name}")
+        return {'sha256': digest.hexdigest(), 'size': offset + written}
+    except Exception as e:
+        logging.error(f"Failed to download {url}: {e}")
+        return False
+
+def existing_file(url, file_name, session):
+    # Files saved before downloads went through .part files may have been cut
+    # short, so one is only kept once its size matches what the server sends.
+    # Returns its {'sha256', 'size'}, both None when the server gives no size to
+    # check against (verify then reports it as unhashed), or False when it was
+    # short and has been removed to be downloaded again.
+    try:
+        with session.head(url, allow_redirects=True) as response:
+            status, headers = response.status_code, response.headers
+    except Exception as e:
+        logging.warning(f"Keeping {file_name} unverified, could not check its size: {e}")
+        return {'sha256': None, 'size': None}
+    expected_size = headers.get('Content-Length') if status == 200 and not headers.get('Content-Encoding') else None
+    if expected_size is None:
+        logging.warning(f"Keeping {file_name} unverified, the server gave no size to check it against")
+        return {'sha256': None, 'size': None}
+    size = os.path.getsize(file_name)
+    if size != int(expected_size):
+        logging.warning(f"Downloading {file_name} again, it has {size} of {expected_size} bytes")
+        os.remove(file_name)
+        return False
+    logging.info(f"File already exists: {file_name}")
+    return file_digest(file_name)
+
+def write_response(response, part_name, mode, offset, expected_size, config, throttle=None, digest=None):
+    # Streams the body to part_name from offset and returns the bytes written.
+    # The body is read into one reused buffer, hundreds of KB at a time, rather than
+    # as a new 8 KB bytes object per chunk, and hashed into digest on the way.
+    buffer_size = config.get('download_buffer_size', DEFAULT_BUFFER_SIZE)
+    # A preallocated file is as long as the download from the start, so its
+    # progress is kept in a .segments file like a segmented download's, saved
+    # every PROGRESS_BYTES; a crash then resumes it from there instead of
+    # trusting the file size
+    segments_file = part_name + '.segments'
+    preallocated = (expected_size is not None
+                    and response.headers.get('Accept-Ranges', '').lower() == 'bytes')
+    written = 0
+    unsaved = 0
+    with open(part_name, 'r+b' if mode == 'ab' else 'wb') as f:
+        f.seek(offset)
+        if preallocated:
+            total_size = offset + int(expected_size)
+            state = {'total_size': total_size, 'segments': [[0, total_size - 1, offset]]}
+            save_segments(segments_file, state)
+            preallocate(f, total_size)
+
+        def save_progress():
+            f.flush()  # The bytes reach the file before the progress that counts them
+            state['segments'][0][2] = offset + written
+            save_segments(segments_file, state)
+
+        try:
+            if response.headers.get('Content-Encoding'):
+                chunks = response.iter_content(chunk_size=buffer_size)  # Only requests can decode it
+                for chunk in chunks:
+                    f.write(chunk)
+                    written += len(chunk)
+                    unsaved += len(chunk)
+                    if preallocated and unsaved >= PROGRESS_BYTES:
+                        save_progress()
+                        unsaved = 0
+                    if digest:
+                        digest.update(chunk)
+                    if throttle:
+                        throttle(len(chunk))
+            else:
+                buffer = bytearray(buffer_size)
+                view = memoryview(buffer)
+                while True:
+                    size = response.raw.readinto(buffer)
+                    if not size:
+                        break
+                    f.write(view[:size])
+                    written += size
+                    unsaved += size
+                    if preallocated and unsaved >= PROGRESS_BYTES:
+                        save_progress()
+                        unsaved = 0
+                    if digest:
+                        digest.update(view[:size])
+                    if throttle:
+                        throttle(size)
+        finally:
+            if preallocated and written == int(expected_size):
+                os.remove(segments_file)
+            elif preallocated:
+                save_progress()
+    return written
+
+def file_digest(file_name, size=None, digest=False):
+    # Hashes the first size bytes of a file (all of it by default). Returns its
+    # {'sha256', 'size'}, or with digest set the hash object, to carry on with.
+    hasher = hashlib.sha256()
+    remaining = os.path.getsize(file_name) if size is None else size
+    total = remaining
+    with open(file_name, 'rb') as f:
+        while remaining:
+            block = f.read(min(remaining, DEFAULT_BUFFER_SIZE))
+            if not block:
+                raise IOError(f"{file_name} is shorter than {total} bytes")
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher if digest else {'sha256': hasher.hexdigest(), 'size': total}
+
+def restart(error, url, file_name, part_name, session, config, throttle, spare_slots, restarted):
+    # Throws the .part file away and downloads the file again from the start, once
+    discard_part(part_name)
+    if restarted:
+        logging.error(f"Failed to download {url}: {error}")
+        return False
+    logging.warning(f"Restarting {file_name}: {error}")
+    return download_file(url, file_name, session, config, throttle, spare_slots, True)
+
+def save_source(part_name, url, response):
+    # Records where a .part file's bytes come from: the URL, and the validator
+    # the server gave them, sent back in If-Range so a resume gets the same file
+    etag = response.headers.get('ETag', '')
+    validator = etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified')
+    save_json(part_name + '.source', {'url': url, 'validator': validator})
+
+def load_source(part_name):
+    try:
+        with open(part_name + '.source') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def resume_headers(source, offset, last=''):
+    # With If-Range, a server whose file has changed sends all of it with a 200
+    headers = {'Range': f'bytes={offset}-{last}'}
+    if source and source.get('validator'):
+        headers['If-Range'] = source['validator']
+    return headers
+
+def range_start(response):
+    # The first byte of a 206 response, from "bytes first-last/total"
+    try:
+        return int(response.headers.get('Content-Range', '').split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+def discard_part(part_name):
+    for name in [part_name, part_name + '.segments', part_name + '.source']:
+        if os.path.exists(name):
+            os.remove(name)
+
+def save_json(file_name, state):
+    # Written to a temporary file first, so a crash never leaves half a file behind
+    temp_name = file_name + '.tmp'
+    with open(temp_name, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_name, file_name)
+
+def preallocate(f, size):
+    # Reserves the file's blocks up front, so a large file isn't fragmented
+    # as it grows; where posix_fallocate is missing the file is just extended
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError):
+        f.truncate(size)
+
+def finish_file(part_name, file_name, config):
+    # Renames a complete .part file into place, synced to disk as fsync says:
+    # "file" syncs every file before its rename, "batch" syncs them in groups
+    # of fsync_batch_size, and "off" leaves it to the operating system
+    mode = config.get('fsync', DEFAULT_FSYNC)
+    if mode == 'file':
+        sync_file(part_name)
+    os.replace(part_name, file_name)
+    if os.path.exists(part_name + '.source'):
+        os.remove(part_name + '.source')
+    if mode == 'file':
+        sync_directory(os.path.dirname(file_name))
+    elif mode == 'batch':
+        with _unsynced_lock:
+            _unsynced.append(file_name)
+            if len(_unsynced) < config.get('fsync_batch_size', DEFAULT_FSYNC_BATCH):
+                return
+            batch = list(_unsynced)
+            _unsynced.clear()
+        sync_files(batch)
+
+def sync_pending():
+    # Syncs what is left of the current batch, at the end of a run
+    with _unsynced_lock:
+        batch = list(_unsynced)
+        _unsynced.clear()
+    sync_files(batch)
+
+def sync_files(file_names):
+    for file_name in file_names:
+        sync_file(file_name)
+    for directory in {os.path.dirname(file_name) for file_name in file_names}:
+        sync_directory(directory)
+
+def sync_file(file_name):
+    try:
+        with open(file_name, 'r+b') as f:
+            os.fsync(f.fileno())
+    except OSError as e:
+        logging.warning(f"Failed to sync {file_name}: {e}")  # Moved to the blob store since, or gone
+
+def sync_directory(directory):
+    # Makes the rename itself durable; directories can't be opened on Windows
+    try:
+        fd = os.open(directory or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def finish_range_not_satisfiable(response, part_name, file_name, offset, config):
+    # A 416 for a resume usually means the .part file already holds every byte
+    content_range = response.headers.get('Content-Range', '')
+    total = content_range.rsplit('/', 1)[-1]
+    if total.isdigit() and int(total) == offset:
+        finish_file(part_name, file_name, config)
+        logging.info(f"Downloaded {file_name}")
+        return file_digest(file_name)
+    logging.error(f"Discarding {part_name}: it does not match the remote file ({content_range or 'unknown size'})")
+    discard_part(part_name)
+    return False
+
+def should_segment(response, expected_size, config):
+    segments = config.get('download_segments', DEFAULT_SEGMENTS)
+    threshold = config.get('segmented_download_threshold', DEFAULT_SEGMENT_THRESHOLD)
+    return (segments > 1 and expected_size is not None and int(expected_size) >= threshold
+            and response.headers.get('Accept-Ranges', '').lower() == 'bytes')
+
+def download_segmented(url, file_name, part_name, total_size, session, config, throttle=None, spare_slots=None,
+                       restarted=False):
+    # Large files are fetched as N byte ranges over parallel connections and
+    # written in place. The .segments file records how far each range got, so
+    # a .part file with holes in it is never mistaken for a short one. The
+    # ranges arrive out of order, so these are hashed in a second read.
+    segments_file = part_name + '.segments'
+    if total_size is None:
+        try:
+            with open(segments_file) as f:
+                state = json.load(f)
+        except ValueError as e:
+            return restart(f"{segments_file} is unreadable ({e})", url, file_name, part_name, session, config,
+                           throttle, spare_slots, restarted)
+        logging.info(f"Resuming segmented download of {file_name}")
+    else:
+        count = config.get('download_segments', DEFAULT_SEGMENTS)
+        size = -(-total_size // count)
+        state = {
+            'total_size': total_size,
+            'segments': [[start, min(start + size, total_size) - 1, start] for start in range(0, total_size, size)]
+        }
+        save_segments(segments_file, state)
+        with open(part_name, 'wb') as f:
+            preallocate(f, total_size)
+
+    pending = [segment for segment in state['segments'] if segment[2] <= segment[1]]
+    buffer_size = config.get('download_buffer_size', DEFAULT_BUFFER_SIZE)
+    source = load_source(part_name)
+    # Progress is saved as the ranges come in, so a killed run resumes each
+    # range from about where it got to, not from where it started
+    lock = threading.Lock()
+
+    def save_progress():
+        with lock:
+            save_segments(segments_file, state)
+
+    # The download holds one of the host's slots; each further connection takes
+    # another free one, and ranges wait for a connection when there are none
+    connections = len(pending)
+    if spare_slots:
+        connections = 1 + spare_slots.take(len(pending) - 1)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as executor:
+            results = list(executor.map(
+                lambda segment: download_segment(url, part_name, segment, session, throttle, buffer_size, source,
+                                                 save_progress),
+                pending
+            ))
+    except RemoteFileChanged as e:
+        return restart(e, url, file_name, part_name, session, config, throttle, spare_slots, restarted)
+    finally:
+        if spare_slots:
+            spare_slots.give_back(connections - 1)
+
+    if not all(results):
+        save_segments(segments_file, state)
+        logging.error(f"Incomplete segmented download of {url}, will resume next run")
+        return False
+
+    result = file_digest(part_name)
+    if result['size'] != state['total_size']:
+        logging.error(f"Discarding {part_name}: {result['size']} bytes instead of {state['total_size']}")
+        discard_part(part_name)
+        return False
+    os.remove(segments_file)
+    finish_file(part_name, file_name, config)
+    logging.info(f"Downloaded {file_name} in {len(state['segments'])} segments")
+    return result
+
+def download_segment(url, part_name, segment, session, throttle=None, buffer_size=DEFAULT_BUFFER_SIZE, source=None,
+                     save_progress=None):
+    # segment is [first byte, last byte, next byte to fetch], updated as bytes land
+    # and saved with save_progress every PROGRESS_BYTES
+    try:
+        headers = resume_headers(source, segment[2], segment[1])
+        with session.get(url, stream=True, headers=headers) as response:
+            changed = response.status_code == 200 and 'If-Range' in headers
+            if changed or (response.status_code == 206 and range_start(response) != segment[2]):
+                raise RemoteFileChanged(f"asked for byte {segment[2]} on, got status code {response.status_code} "
+                                        f"{response.headers.get('Content-Range', '')}")
+            if response.status_code != 206:
+                logging.error(f"Range request for {url} returned status code {response.status_code}")
+                return False
+            with open(part_name, 'r+b') as f:
+                f.seek(segment[2])
+                unsaved = 0
+                for chunk in response.iter_content(chunk_size=buffer_size):
+                    if chunk:
+                        f.write(chunk[:segment[1] + 1 - segment[2]])
+                        segment[2] = min(segment[2] + len(chunk), segment[1] + 1)
+                        unsaved += len(chunk)
+                        if save_progress and unsaved >= PROGRESS_BYTES:
+                            f.flush()  # The bytes reach the file before the progress that counts them
+                            save_progress()
+                            unsaved = 0
+                        if throttle:
+                            throttle(len(chunk))
+            if save_progress:
+                save_progress()
+        return segment[2] > segment[1]
+    except RemoteFileChanged:
+        raise
+    except Exception as e:
+        logging.error(f"Failed to download bytes {segment[2]}-{segment[1]} of {url}: {e}")
+        return False
+
+def save_segments(segments_file, state):
+    save_json(segments_file, state)
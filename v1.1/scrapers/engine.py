@@ -0,0 +1,523 @@
+# scrapers/engine.py
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
+
+from scrapers import adaptive, catalog, dedupe, downloader, http_client, jobqueue, phash, ratelimit, renditions, response_cache
+
+DEFAULT_MAX_IN_FLIGHT = 100
+DEFAULT_WORKERS = 8
+DEFAULT_PER_HOST = 4
+DEFAULT_LOOKAHEAD = 1
+DEFAULT_SITE_CONCURRENCY = 16
+DEFAULT_KEYWORD_CONCURRENCY = 4
+DEFAULT_MAX_RATE_LIMIT_WAIT = 900
+MAX_THROTTLED_RETRIES = 5
+DEFAULT_KNOWN_RATIO = 0.8
+
+# An adapter is a scraper module that provides:
+#   WEBSITE, SITE_NAME
+#   RATE_LIMIT -> (requests, period in seconds) of the default API quota
+#   parse_rate_limit(headers) -> (remaining, seconds until reset) or None
+#   get_content_type(args)
+#   build_query(keyword_set, args)
+#   build_search_request(query, content_type, page, args, config) -> (url, headers)
+#   get_items(data, content_type)
+#   select_file(item, args, content_type) -> (file_url, default_extension), or the
+#       reason the item was skipped (see renditions.SKIP_REASONS)
+#   item_metadata(item) -> site specific metadata fields
+
+class IncompleteRun(Exception):
+    # Raised by run() when a search failed before some keyword sets were done.
+    # Their checkpoints stay open, so the job can be resumed from where it stopped.
+    def __init__(self, results, unfinished):
+        super().__init__(f"Search failed before finishing: {', '.join(unfinished)}")
+        self.results = results
+        self.unfinished = unfinished
+
+class Client:
+    # Shared by every coroutine of a run. requests is blocking, so calls are
+    # handed to a thread pool large enough to keep hundreds of them in flight.
+    def __init__(self, config, adapter):
+        self.config = config
+        self.adapter = adapter
+        self.site_name = adapter.SITE_NAME
+        self.rate_limiter = ratelimit.get_limiter(adapter.WEBSITE, config, *adapter.RATE_LIMIT)
+        self.session = http_client.create_session(config)
+        self.session.hooks['response'].append(self.on_response)
+        self.loop = asyncio.get_running_loop()
+        self.cache = response_cache.get_cache(config)
+        self.executor = ThreadPoolExecutor(max_workers=config.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT))
+        self.host_slots = {}
+        # (content type, item id, file url) -> future of the (file name, sha256)
+        # it is being saved as, while it downloads
+        self.in_flight = {}
+        # Budget shared by every keyword set of the site, searches and downloads alike
+        self.site_slots = asyncio.Semaphore(config.get('site_concurrency', DEFAULT_SITE_CONCURRENCY))
+
+    def host_slot(self, url):
+        # Starts from the limit the last run learned for the host
+        host = urlparse(url).netloc
+        if host not in self.host_slots:
+            per_host = self.config.get('max_connections_per_host', DEFAULT_PER_HOST)
+            self.host_slots[host] = adaptive.AdaptiveLimit(
+                host,
+                adaptive.learned_limit(self.config, host, per_host),
+                self.config.get('adaptive_max_connections', adaptive.DEFAULT_MAX_LIMIT),
+                self.config.get('adaptive_concurrency', True)
+            )
+        return self.host_slots[host]
+
+    def on_response(self, response, *args, **kwargs):
+        # requests hook, called in the worker thread; the limits live on the event loop
+        host = urlparse(response.url).netloc
+        self.loop.call_soon_threadsafe(self.record_response, host, response.status_code,
+                                       response.elapsed.total_seconds())
+
+    def record_response(self, host, status, latency):
+        if host in self.host_slots:
+            self.host_slots[host].record(status, latency)
+
+    async def call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def get(self, url, headers=None):
+        # Search calls are paced to the site's API quota; file downloads don't count against it
+        max_wait = self.config.get('max_rate_limit_wait', DEFAULT_MAX_RATE_LIMIT_WAIT)
+        for attempt in range(MAX_THROTTLED_RETRIES + 1):
+            wait = self.rate_limiter.reserve()
+            if wait > max_wait:
+                raise RuntimeError(f"{self.site_name} API quota exhausted, it resets in {wait:.0f}s")
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            async with self.host_slot(url), self.site_slots:
+                response = await self.call(partial(self.session.get, url, headers=headers))
+
+            quota = self.adapter.parse_rate_limit(response.headers)
+            if quota:
+                self.rate_limiter.update(*quota)
+            if response.status_code != 429:
+                return response
+
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                wait = int(retry_after)
+            elif quota:
+                wait = quota[1]
+            else:
+                wait = self.rate_limiter.period / self.rate_limiter.capacity
+            wait = self.rate_limiter.throttled(wait)
+            logging.warning(f"{self.site_name} rate limit hit, waiting {wait:.0f}s before retrying")
+        return response
+
+    async def search(self, url, headers=None):
+        # Returns the parsed search page, or None if the site refused it.
+        # Fresh cached pages cost neither quota nor a round trip.
+        key = response_cache.cache_key(url)
+        if self.cache:
+            body = await self.call(self.cache.get, key)
+            if body is not None:
+                return json.loads(body)
+
+        response = await self.get(url, headers)
+        if response.status_code != 200:
+            logging.error(f"Failed to fetch data from {self.site_name}: {response.status_code}")
+            return None
+        if self.cache:
+            await self.call(self.cache.put, key, response.content)
+        return response.json()
+
+    async def download(self, url, file_name, content_type, item_id, known, flow=None):
+        website = self.adapter.WEBSITE
+        if not self.config.get('dedupe', True):
+            return await self.fetch(url, file_name, content_type, item_id, known, flow)
+
+        # Parallel keyword sets often reach the same item at once; the later
+        # ones wait for the download under way and link to its file
+        key = (content_type, item_id, url)
+        while key in self.in_flight:
+            saved = await asyncio.shield(self.in_flight[key])
+            if saved:
+                known = known + [saved]
+                break
+
+        # Files we already have are linked, not fetched, so they skip the host limits
+        if known:
+            return await self.call(dedupe.fetch_file, url, file_name, website, content_type, item_id, known,
+                                   self.session, self.config, flow)
+
+        self.in_flight[key] = self.loop.create_future()
+        result = False
+        try:
+            if self.config.get('worker_id'):
+                # Another worker's copy is waited for before taking any slot
+                owner_file = await dedupe.wait_for_owner(self, self.config, website, content_type, item_id, url,
+                                                         file_name)
+                if owner_file:
+                    result = await self.call(dedupe.fetch_file, url, file_name, website, content_type, item_id,
+                                             known, self.session, self.config, flow, owner_file)
+                    return result
+            result = await self.fetch(url, file_name, content_type, item_id, known, flow)
+            return result
+        finally:
+            self.in_flight.pop(key).set_result((file_name, result['sha256']) if result else None)
+
+    async def fetch(self, url, file_name, content_type, item_id, known, flow=None):
+        slot = self.host_slot(url)
+        async with slot, self.site_slots:
+            # A segmented download takes more of the host's slots for its other connections
+            spare_slots = adaptive.SpareSlots(slot, self.loop)
+            started = time.monotonic()
+            result = await self.call(dedupe.fetch_file, url, file_name, self.adapter.WEBSITE, content_type, item_id,
+                                     known, self.session, self.config, flow, None, spare_slots)
+            slot.record_transfer(spare_slots.received, time.monotonic() - started, spare_slots.connections)
+            return result
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        downloader.sync_pending()
+        http_client.log_connection_stats(self.session, self.site_name)
+        for host, slot in sorted(self.host_slots.items()):
+            logging.info(f"{self.site_name} concurrency for {host} ended at {int(slot.limit)}")
+        adaptive.save(self.config)
+        self.session.close()
+
+async def run(adapter, args, config, client=None, job_id=None):
+    # Returns the number of files saved for each keyword set, or raises
+    # IncompleteRun if a search failed part way. A client passed in is shared
+    # with other runs and left open for its owner to close.
+    # With a job_id, progress is checkpointed to the job queue as pages complete.
+    own_client = client is None
+    if own_client:
+        client = Client(config, adapter)
+    keyword_slots = asyncio.Semaphore(config.get('keyword_set_concurrency', DEFAULT_KEYWORD_CONCURRENCY))
+    heartbeat = asyncio.ensure_future(keep_alive(client, config, job_id)) if job_id else None
+
+    async def scrape_with_slot(keyword_set):
+        async with keyword_slots:
+            return await scrape_keyword_set(adapter, client, args, config, keyword_set, job_id)
+
+    # Keyword sets are independent: each keeps its own pages and metadata file
+    tasks = [asyncio.ensure_future(scrape_with_slot(keyword_set)) for keyword_set in args['keyword_sets']]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        # One keyword set failing fails the run, so the others stop with it
+        # instead of downloading on for a job that is already marked failed
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        if heartbeat:
+            heartbeat.cancel()
+        if own_client:
+            client.close()
+        if config.get('export_metadata_json', True):
+            catalog.export_json(config, website=adapter.WEBSITE, keyword_sets=args['keyword_sets'])
+        else:
+            catalog.get_catalog(config).flush()
+    unfinished = [keyword_set for keyword_set, (_, finished) in zip(args['keyword_sets'], results) if not finished]
+    results = {keyword_set: files_saved for keyword_set, (files_saved, _) in zip(args['keyword_sets'], results)}
+    if unfinished:
+        raise IncompleteRun(results, unfinished)
+    return results
+
+async def keep_alive(client, config, job_id):
+    # Shows the job is still running, so resume in another process leaves it alone
+    queue = jobqueue.get_queue(config)
+    while True:
+        await client.call(queue.heartbeat, job_id)
+        await asyncio.sleep(jobqueue.HEARTBEAT)
+
+async def scrape_keyword_set(adapter, client, args, config, keyword_set, job_id=None):
+    # Returns (files saved, whether the keyword set is finished)
+    content_type = adapter.get_content_type(args)
+    query = adapter.build_query(keyword_set, args)
+    total_downloaded = 0
+    files_saved = 0
+    harvest = harvest_key(adapter, args, config, content_type, query) if config.get('incremental') else None
+
+    queue = jobqueue.get_queue(config) if job_id else None
+    checkpoint = await client.call(queue.load_checkpoint, job_id, keyword_set) if queue else None
+    if checkpoint and checkpoint['done']:
+        return checkpoint['files_saved'], True
+    next_page = args.get('first_page', 1)  # Work units of a distributed harvest cover a page range
+    pending = None
+    if checkpoint:
+        next_page = checkpoint['page']
+        total_downloaded = checkpoint['downloaded']
+        files_saved = checkpoint['files_saved']
+        pending = checkpoint['pending']
+        logging.info(f"Resuming {keyword_set} on {adapter.SITE_NAME} from page {next_page}, "
+                     f"{files_saved} files saved so far")
+
+    # The next search page is fetched while the current one downloads
+    pages = asyncio.Queue()
+    page_slots = asyncio.Semaphore(config.get('search_lookahead', DEFAULT_LOOKAHEAD) + 1)
+    if pending:
+        # The page the last run was saving when it stopped comes first
+        await page_slots.acquire()
+        pages.put_nowait((next_page - 1, pending))
+    items_fetched = total_downloaded + len(pending or [])
+    pager = asyncio.ensure_future(fetch_pages(adapter, client, args, config, content_type, query, pages, page_slots,
+                                              harvest, next_page, items_fetched))
+
+    try:
+        while total_downloaded < args['num_results']:
+            entry = await pages.get()
+            if entry is None:
+                break
+
+            page, items = entry
+            next_page = page + 1
+            if queue:
+                await client.call(queue.save_checkpoint, job_id, keyword_set, next_page, total_downloaded,
+                                  files_saved, items)
+            num_to_download = args['num_results'] - total_downloaded
+            files_saved += await save_content(adapter, client, items, args, config, content_type, keyword_set,
+                                              num_to_download, harvest)
+            total_downloaded += min(len(items), num_to_download)
+            if queue:
+                await client.call(queue.save_checkpoint, job_id, keyword_set, next_page, total_downloaded, files_saved)
+            page_slots.release()
+    finally:
+        pager.cancel()
+        try:
+            # Re-raises anything the pager failed with
+            await pager
+        except asyncio.CancelledError:
+            pass
+
+    # A search that failed part way leaves the job to be resumed later
+    finished = total_downloaded >= args['num_results'] or pager.result()
+    if queue and finished:
+        await client.call(queue.save_checkpoint, job_id, keyword_set, next_page, total_downloaded, files_saved,
+                          None, True)
+    return files_saved, finished
+
+def harvest_key(adapter, args, config, content_type, query):
+    # Identifies a search and its filters for incremental crawls: the search
+    # URL without its page, plus the filters applied to the results
+    url, _ = adapter.build_search_request(query, content_type, 1, args, config)
+    search = response_cache.cache_key(url, ignore={'page'})
+    return f"{search} quality={args['quality']} format={args['format']}"
+
+async def fetch_pages(adapter, client, args, config, content_type, query, pages, page_slots, harvest=None,
+                      page=1, items_fetched=0):
+    # Returns False if a search failed before the results ran out
+    known_ratio = config.get('incremental_known_ratio', DEFAULT_KNOWN_RATIO)
+    last_page = args.get('last_page')
+    try:
+        while items_fetched < args['num_results'] and (last_page is None or page <= last_page):
+            await page_slots.acquire()
+            url, headers = adapter.build_search_request(query, content_type, page, args, config)
+            data = await client.search(url, headers)
+            if data is None:
+                return False  # Proceed to next keyword set
+
+            items = adapter.get_items(data, content_type)
+            if not items:
+                logging.info(f"No results found for query: {query} on page {page}")
+                break
+
+            mostly_known = False
+            if harvest:
+                # Only items this search has not been through before count towards num_results
+                seen = await client.call(catalog.get_catalog(config).harvested_ids,
+                                         adapter.WEBSITE, harvest, [item['id'] for item in items])
+                mostly_known = len(seen) >= known_ratio * len(items)
+                items = [item for item in items if item['id'] not in seen]
+
+            if items:
+                pages.put_nowait((page, items))
+            else:
+                page_slots.release()
+            items_fetched += len(items)
+            page += 1
+            if mostly_known:
+                logging.info(f"Page {page - 1} of {query} is mostly harvested already, stopping here")
+                break
+    finally:
+        # Always wake the consumer up, even when the search failed
+        pages.put_nowait(None)
+    return True
+
+async def select_rendition(adapter, item, args, content_type, dir_path):
+    selected = adapter.select_file(item, args, content_type)
+    if not isinstance(selected, tuple):
+        return selected or renditions.SKIP_NO_FILE  # Skip if no matching file is found
+    file_url, default_extension = selected
+    file_extension = os.path.splitext(file_url)[1].split('?')[0] or default_extension
+    file_name = os.path.join(dir_path, f"{item['id']}{file_extension}")
+    return item, file_url, file_name
+
+async def save_content(adapter, client, items, args, config, content_type, keyword_set, num_to_download, harvest=None):
+    website = adapter.WEBSITE
+    db_path = config['database_path']
+    quality = args['quality']
+    fmt = args['format']
+    fmt_sanitized = args['format_sanitized']
+    categories = '_'.join(args['categories']) if args['categories'] else 'All'
+    styles = '_'.join(args['styles']) if args['styles'] else 'All'
+
+    # Sanitize keyword set for directory name
+    keyword_dir = keyword_set.replace(' ', '_')
+
+    # Construct the directory path
+    dir_path = os.path.join(db_path, website, keyword_dir, categories, styles, content_type, quality, fmt_sanitized)
+    os.makedirs(dir_path, exist_ok=True)
+
+    selections = await asyncio.gather(*(
+        select_rendition(adapter, item, args, content_type, dir_path) for item in items
+    ))
+    near_duplicates = args['content_type'] == '1' and phash.enabled(config)
+    if near_duplicates and config.get('near_duplicates') == 'skip':
+        # Results dropped as near duplicates by an earlier run aren't downloaded again
+        dropped = await client.call(catalog.get_catalog(config).skipped_ids, website,
+                                    [selection[0]['id'] for selection in selections if isinstance(selection, tuple)])
+        selections = [phash.SKIP_NEAR_DUPLICATE if isinstance(selection, tuple) and selection[0]['id'] in dropped
+                      else selection for selection in selections]
+    candidates = [selection for selection in selections if isinstance(selection, tuple)]
+    skipped = Counter(selection for selection in selections if isinstance(selection, str))
+    if skipped:
+        reasons = ', '.join(f"{reason}: {count}" for reason, count in skipped.most_common())
+        logging.info(f"Skipped {sum(skipped.values())} of {len(items)} results for {keyword_set} ({reasons})")
+
+    # Only a copy of the same rendition counts as known, not just the same id
+    known = await client.call(dedupe.find_known, config, website, content_type,
+                              [(item['id'], url) for item, url, _ in candidates])
+    downloads = [(url, name, content_type, item['id'], known.get(item['id'], [])) for item, url, name in candidates]
+    # Bandwidth caps are shared fairly between the keyword sets of every job
+    flow = (website, args.get('name'), keyword_set)
+    check = await near_duplicate_check(client, config, website) if near_duplicates else None
+    results = await download_all(client, downloads, num_to_download, config, flow, check)
+
+    # Record metadata in result order, whatever order the downloads finished in
+    metadata_list = []
+    for (item, file_url, file_name), download_success in zip(candidates, results):
+        if download_success is None:
+            continue
+        if download_success:
+            # Collect metadata
+            metadata = {
+                'file_name': file_name,
+                'file_url': file_url,
+                'website': website,
+                'keywords': keyword_set,
+                'categories': args['categories'],
+                'styles': args['styles'],
+                'content_type': content_type,
+                'quality': quality,
+                'format': fmt,
+                'id': item['id'],
+            }
+            metadata.update(adapter.item_metadata(item))
+            metadata.update(download_success)
+            metadata_list.append(metadata)
+            if 'linked_from' in download_success:
+                print(f"Linked {file_name}")
+            else:
+                print(f"Downloaded {file_name}")
+        else:
+            logging.info(f"Failed to download {file_name}")
+
+    if harvest:
+        # Items without a matching file won't have one next time either
+        harvested = [item['id'] for item, selection in zip(items, selections) if isinstance(selection, str)]
+        harvested += [metadata['id'] for metadata in metadata_list]
+        await client.call(catalog.get_catalog(config).mark_harvested, website, harvest, harvested)
+
+    if not metadata_list:
+        logging.info(f"No valid items found to save for query: {keyword_set}")
+        return 0
+
+    catalog.get_catalog(config).add(metadata_list)
+    return len(metadata_list)
+
+async def near_duplicate_check(client, config, website):
+    # Post-download stage for download_all: perceptual hashes are computed in
+    # worker processes and looked up in a BK-tree of every image in the catalog
+    mode = config.get('near_duplicates', 'off')
+    algorithm = config.get('phash_algorithm', phash.DEFAULT_ALGORITHM)
+    max_distance = config.get('phash_max_distance', phash.DEFAULT_MAX_DISTANCE)
+    loop = asyncio.get_running_loop()
+    pool = phash.get_pool(config)
+    index = await client.call(phash.get_index, catalog.get_catalog(config))
+
+    async def check(download, result):
+        url, file_name, content_type, item_id, known = download
+        if file_name in [name for name, _ in known]:
+            return result  # Kept from an earlier run, its hash is in the catalog already
+        bits = await loop.run_in_executor(pool, phash.compute, file_name, algorithm)
+        if bits is None:
+            return result
+        match = phash.find_match(index, bits, result['sha256'], max_distance)
+        if match and mode == 'skip':
+            logging.info(f"Skipping {file_name}, it is a near duplicate of {match[2]}")
+            await client.call(dedupe.discard, config, website, content_type, item_id, url, file_name,
+                              result['sha256'])
+            # Remembered, so later runs drop the result before downloading it
+            await client.call(catalog.get_catalog(config).mark_skipped, website, item_id,
+                              phash.SKIP_NEAR_DUPLICATE, match[2])
+            return None
+        if match:
+            result['near_duplicate_of'] = match[2]
+        result['phash'] = f"{bits:016x}"
+        phash.add(index, bits, (website, item_id, file_name, result['sha256']))
+        return result
+    return check
+
+async def download_all(client, downloads, num_to_download, config, flow=None, check=None):
+    # downloads is a list of (url, file_name, content_type, item_id, known
+    # copies) in result order. Returns the saved file's metadata fields or False
+    # per entry, or None for entries that were never needed or were dropped by check.
+    # check(download, result), awaited as each file is saved, returns the
+    # result to keep or None; a dropped file is replaced like a failed one.
+    results = [None] * len(downloads)
+    workers = max(1, config.get('download_workers', DEFAULT_WORKERS))
+    succeeded = 0
+    next_index = 0
+    in_flight = {}
+
+    async def download(index):
+        result = await client.download(*downloads[index], flow)
+        if result and check:
+            result = await check(downloads[index], result)
+        return result
+
+    try:
+        while True:
+            # Only keep as many downloads running as we still need successes,
+            # so a failure is replaced by the next item, like the serial loop did
+            while (next_index < len(downloads) and len(in_flight) < workers
+                   and succeeded + len(in_flight) < num_to_download):
+                task = asyncio.ensure_future(download(next_index))
+                in_flight[task] = next_index
+                next_index += 1
+
+            if not in_flight:
+                break
+
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = in_flight.pop(task)
+                results[index] = task.result()
+                if results[index]:
+                    succeeded += 1
+    finally:
+        # Downloads still queued when the keyword set is cancelled are dropped with it
+        for task in in_flight:
+            task.cancel()
+        if in_flight:
+            await asyncio.wait(in_flight)
+
+    return results
@@ -0,0 +1,52 @@
+# scrapers/http_client.py
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_RETRIES = {
+    'total': 3,
+    'backoff_factor': 0.5,
+    'status_forcelist': [500, 502, 503, 504]
+}
+
+def create_session(config):
+    # One session per site and run, so search and download calls to the same
+    # host reuse kept-alive connections instead of a new TCP+TLS handshake each
+    pool_size = config.get('http_pool_size', DEFAULT_POOL_SIZE)
+    retry_settings = dict(DEFAULT_RETRIES)
+    retry_settings.update(config.get('http_retries', {}))
+    retries = Retry(
+        total=retry_settings['total'],
+        backoff_factor=retry_settings['backoff_factor'],
+        status_forcelist=retry_settings['status_forcelist'],
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=pool_size, max_retries=retries)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def connection_stats(session):
+    # Per host: requests sent and connections opened (each one a handshake)
+    stats = {}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host_stats = stats.setdefault(pool.host, {'requests': 0, 'handshakes': 0})
+            host_stats['requests'] += pool.num_requests
+            host_stats['handshakes'] += pool.num_connections
+    return stats
+
+def log_connection_stats(session, site_name):
+    for host, host_stats in sorted(connection_stats(session).items()):
+        reused = max(0, host_stats['requests'] - host_stats['handshakes'])
+        logging.info(
+            f"{site_name} connections to {host}: {host_stats['requests']} requests, "
+            f"{host_stats['handshakes']} handshakes, {reused} reused"
+        )
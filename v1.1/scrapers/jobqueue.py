@@ -0,0 +1,150 @@
+# scrapers/jobqueue.py
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+HEARTBEAT = 30  # Seconds between two heartbeats of a running job
+STALE_AFTER = 4 * HEARTBEAT  # A running job silent this long was left by a crash
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    site TEXT NOT NULL,
+    args TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    error TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    job_id INTEGER NOT NULL REFERENCES jobs (id),
+    keyword_set TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    downloaded INTEGER NOT NULL,
+    files_saved INTEGER NOT NULL,
+    pending TEXT,
+    done INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, keyword_set)
+);
+"""
+
+# Columns added after the first release of the job queue
+MIGRATIONS = {
+    'owner': "ALTER TABLE jobs ADD COLUMN owner TEXT",
+    'heartbeat': "ALTER TABLE jobs ADD COLUMN heartbeat REAL",
+}
+
+# Arguments that say where a job runs rather than what it fetches
+RUN_ARGS = {'name', 'sites', 'websites'}
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+def job_key(site, args):
+    return site + ' ' + json.dumps({name: value for name, value in args.items() if name not in RUN_ARGS}, sort_keys=True)
+
+class JobQueue:
+    # One row per (site, args) job, and one checkpoint per keyword set of it,
+    # committed after every results page so a crashed run picks up where it stopped
+    def __init__(self, path, wal=True):
+        self.path = path
+        self.wal = wal
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = self.connect()
+        connection.executescript(SCHEMA)
+        existing_columns = {row[1] for row in connection.execute("PRAGMA table_info(jobs)")}
+        for column, statement in MIGRATIONS.items():
+            if column not in existing_columns:
+                connection.execute(statement)
+        connection.close()
+
+    def connect(self):
+        # On a shared drive the rollback journal is kept, WAL needs local shared memory
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL' if self.wal else 'PRAGMA journal_mode=DELETE')
+        return connection
+
+    def execute(self, sql, params=()):
+        connection = self.connect()
+        try:
+            with connection:
+                return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+    def add(self, site, args):
+        # The same job left unfinished by an earlier run is resumed, not started over
+        key = job_key(site, args)
+        rows = self.execute("SELECT id FROM jobs WHERE key = ? AND status != 'done' ORDER BY id LIMIT 1", (key,))
+        if rows:
+            return rows[0][0]
+        stored = json.dumps({name: value for name, value in args.items() if name not in RUN_ARGS})
+        connection = self.connect()
+        try:
+            with connection:
+                return connection.execute("INSERT INTO jobs (key, site, args) VALUES (?, ?, ?)",
+                                          (key, site, stored)).lastrowid
+        finally:
+            connection.close()
+
+    def set_status(self, job_id, status, error=None):
+        # A running job is owned by this process, which keeps its heartbeat going
+        if status == 'running':
+            self.execute("UPDATE jobs SET status = ?, error = ?, owner = ?, heartbeat = ?, "
+                         "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                         (status, error, f"{socket.gethostname()} {os.getpid()}", time.time(), job_id))
+        else:
+            self.execute("UPDATE jobs SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                         (status, error, job_id))
+
+    def heartbeat(self, job_id):
+        self.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id))
+
+    def unfinished(self):
+        # (job_id, site, args) of every job not done yet, including ones a crash left
+        # running. Jobs whose process is still alive are left to it, and so are the
+        # jobs of work units, which the work queue hands to the next worker itself.
+        rows = self.execute("SELECT id, site, args, status, heartbeat FROM jobs WHERE status != 'done' ORDER BY id")
+        stale = time.time() - STALE_AFTER
+        jobs = []
+        for job_id, site, args, status, heartbeat in rows:
+            args = json.loads(args)
+            if status == 'running' and (heartbeat or 0) > stale:
+                continue
+            if 'first_page' in args:
+                continue
+            jobs.append((job_id, site, args))
+        return jobs
+
+    def load_checkpoint(self, job_id, keyword_set):
+        rows = self.execute(
+            "SELECT page, downloaded, files_saved, pending, done FROM checkpoints WHERE job_id = ? AND keyword_set = ?",
+            (job_id, keyword_set)
+        )
+        if not rows:
+            return None
+        page, downloaded, files_saved, pending, done = rows[0]
+        return {'page': page, 'downloaded': downloaded, 'files_saved': files_saved,
+                'pending': json.loads(pending) if pending else None, 'done': bool(done)}
+
+    def save_checkpoint(self, job_id, keyword_set, page, downloaded, files_saved, pending=None, done=False):
+        # page is the next search page to fetch; pending holds the results of the
+        # page before it while they are being saved
+        self.execute(
+            "INSERT OR REPLACE INTO checkpoints (job_id, keyword_set, page, downloaded, files_saved, pending, done) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, keyword_set, page, downloaded, files_saved, json.dumps(pending) if pending else None, int(done))
+        )
+
+def get_queue(config):
+    path = config.get('job_queue_path') or os.path.join(config.get('metadata_path', 'metadata'), 'jobs.db')
+    with _queues_lock:
+        if path not in _queues:
+            _queues[path] = JobQueue(path, not config.get('network_databases', False))
+        return _queues[path]
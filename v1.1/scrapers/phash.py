@@ -0,0 +1,131 @@
+# scrapers/phash.py
+import logging
+import math
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, only near-duplicate detection needs it
+    Image = None
+
+DEFAULT_ALGORITHM = 'dhash'
+DEFAULT_MAX_DISTANCE = 6
+
+# Skip reason of the results dropped as near duplicates, see renditions.SKIP_REASONS
+SKIP_NEAR_DUPLICATE = 'near duplicate'
+
+_pool = None
+_index = None
+_lock = threading.Lock()
+
+def enabled(config):
+    mode = config.get('near_duplicates', 'off')
+    if mode == 'off':
+        return False
+    if Image is None:
+        logging.warning("near_duplicates is set but Pillow is not installed (pip install Pillow), skipping it")
+        return False
+    return True
+
+def dhash(file_name, size=8):
+    # One bit per pixel: is it brighter than its right-hand neighbour
+    with Image.open(file_name) as image:
+        pixels = list(image.convert('L').resize((size + 1, size)).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+def phash(file_name, size=8, scale=4):
+    # Low frequencies of a 2D DCT, compared against their median
+    sample = size * scale
+    with Image.open(file_name) as image:
+        pixels = list(image.convert('L').resize((sample, sample)).getdata())
+    cosines = [[math.cos((2 * x + 1) * u * math.pi / (2 * sample)) for x in range(sample)] for u in range(size)]
+    rows = [pixels[y * sample:(y + 1) * sample] for y in range(sample)]
+    # DCT along the rows, then along the columns, keeping only the first size terms
+    row_terms = [[sum(c * p for c, p in zip(cosines[u], row)) for u in range(size)] for row in rows]
+    terms = [sum(cosines[v][y] * row_terms[y][u] for y in range(sample)) for v in range(size) for u in range(size)]
+    median = sorted(terms[1:])[len(terms[1:]) // 2]  # The DC term would skew it
+    bits = 0
+    for term in terms:
+        bits = (bits << 1) | (term > median)
+    return bits
+
+def compute(file_name, algorithm):
+    # Runs in a worker process
+    try:
+        return (phash if algorithm == 'phash' else dhash)(file_name)
+    except Exception as e:
+        logging.error(f"Failed to hash {file_name}: {e}")
+        return None
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    # Metric tree over Hamming distance: a lookup only visits the subtrees
+    # whose edge distance can still be within max_distance of the query
+    def __init__(self):
+        self.root = None
+
+    def add(self, bits, value):
+        node = self.root
+        if node is None:
+            self.root = [bits, [value], {}]
+            return
+        while True:
+            distance = hamming(bits, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            if distance not in node[2]:
+                node[2][distance] = [bits, [value], {}]
+                return
+            node = node[2][distance]
+
+    def search(self, bits, max_distance):
+        found = []
+        nodes = [self.root] if self.root else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming(bits, node[0])
+            if distance <= max_distance:
+                found.extend((distance, value) for value in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    nodes.append(child)
+        return sorted(found, key=lambda match: match[0])
+
+def get_pool(config):
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=config.get('phash_workers') or os.cpu_count())
+        return _pool
+
+def get_index(catalog_db):
+    # Built once per process from every hash already in the catalog
+    global _index
+    with _lock:
+        if _index is None:
+            _index = BKTree()
+            for website, item_id, file_name, sha256, bits in catalog_db.query(
+                    "SELECT website, item_id, file_name, sha256, phash FROM media WHERE phash IS NOT NULL"):
+                _index.add(int(bits, 16), (website, item_id, file_name, sha256))
+        return _index
+
+def find_match(index, bits, sha256, max_distance):
+    # The closest indexed file that isn't the same bytes; those are exact duplicates
+    with _lock:
+        matches = [match for match in index.search(bits, max_distance) if match[1][3] != sha256]
+    return matches[0][1] if matches else None
+
+def add(index, bits, value):
+    with _lock:
+        index.add(bits, value)
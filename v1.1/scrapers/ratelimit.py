@@ -0,0 +1,57 @@
+# scrapers/ratelimit.py
+import threading
+import time
+
+# One limiter per site, shared by every run in the process
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+class RateLimiter:
+    # Token bucket that may go into debt: a caller takes a token and waits
+    # for however long it takes the bucket to earn it back
+    def __init__(self, requests, period):
+        self.capacity = requests
+        self.rate = requests / period
+        self.period = period
+        self.tokens = requests
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # Takes a token and returns how many seconds to wait before using it
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.blocked_until - now)
+
+    def update(self, remaining, reset_in):
+        # The server's count is authoritative, it also sees other clients on our key
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = min(self.tokens, remaining)
+            if remaining <= 0:
+                self.blocked_until = max(self.blocked_until, now + reset_in)
+
+    def throttled(self, wait):
+        # Called on a 429: nobody sends anything until the quota resets
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = min(self.tokens, 0)
+            self.blocked_until = max(self.blocked_until, now + wait)
+            return self.blocked_until - now
+
+def get_limiter(site, config, requests, period):
+    with _limiters_lock:
+        if site not in _limiters:
+            limits = config.get('rate_limits', {}).get(site, {})
+            _limiters[site] = RateLimiter(limits.get('requests', requests), limits.get('period', period))
+        return _limiters[site]
@@ -0,0 +1,98 @@
+# scrapers/renditions.py
+
+# Smallest frame, as (long side, short side), each quality choice stands for
+QUALITY_SIZES = {
+    'HD': (1280, 720),
+    '1080P': (1920, 1080),
+    'UHD': (3840, 2160),
+    '4K': (3840, 2160),
+}
+
+def is_portrait(args):
+    return args['format'] == '9:16'
+
+def min_size(args):
+    # (width, height) a file needs for the selected quality, in the selected orientation
+    long_side, short_side = QUALITY_SIZES.get(args['quality'], QUALITY_SIZES['HD'])
+    return (short_side, long_side) if is_portrait(args) else (long_side, short_side)
+
+def matches_orientation(width, height, args):
+    # Photos are rarely cut to exactly 16:9, so they only need to face the right way
+    return height > width if is_portrait(args) else width > height
+
+def large_enough(width, height, args):
+    min_width, min_height = min_size(args)
+    return width >= min_width and height >= min_height
+
+def fit_within(width, height, max_width, max_height):
+    # Size of an image scaled down, never up, to fit a box
+    scale = min(max_width / width, max_height / height, 1)
+    return round(width * scale), round(height * scale)
+
+def smallest_fitting(variants, args):
+    # variants is a list of (url, width, height). Picks the fewest pixels that
+    # still meet the quality, or the largest variant if none of them does.
+    variants = sorted(variants, key=lambda variant: variant[1] * variant[2])
+    for url, width, height in variants:
+        if large_enough(width, height, args):
+            return url
+    return variants[-1][0]
+
+ASPECT_TOLERANCE = 0.07  # Relative; lets DCI 4K (4096x2160) and slightly cropped frames count as 16:9
+TARGET_FPS = 30
+
+# Why a result was skipped, in the order the checks are made
+SKIP_NO_FILE = 'no usable file'
+SKIP_ORIENTATION = 'wrong orientation'
+SKIP_ASPECT = 'aspect ratio'
+SKIP_RESOLUTION = 'below quality'
+SKIP_REASONS = [SKIP_NO_FILE, SKIP_ORIENTATION, SKIP_ASPECT, SKIP_RESOLUTION]
+
+def check_photo(width, height, args):
+    # The reason a photo can't be used, or None
+    if not matches_orientation(width, height, args):
+        return SKIP_ORIENTATION
+    if not large_enough(width, height, args):
+        return SKIP_RESOLUTION
+    return None
+
+def check_video(variant, args):
+    # The reason a video file can't be used, or None. Videos are often a few
+    # pixels short of the standard frame (1920x1012), so the long side decides.
+    if not variant['url'] or not variant['width'] or not variant['height']:
+        return SKIP_NO_FILE
+    if not matches_orientation(variant['width'], variant['height'], args):
+        return SKIP_ORIENTATION
+    if aspect_error(variant['width'], variant['height'], args) > ASPECT_TOLERANCE:
+        return SKIP_ASPECT
+    if max(variant['width'], variant['height']) < max(min_size(args)):
+        return SKIP_RESOLUTION
+    return None
+
+def aspect_error(width, height, args):
+    min_width, min_height = min_size(args)
+    desired = min_width / min_height
+    return abs(width / height - desired) / desired
+
+def video_score(variant, args):
+    # Lower is better: closest to the quality, then closest to the format,
+    # then closest to TARGET_FPS, then the fewest bytes
+    excess = max(variant['width'], variant['height']) / max(min_size(args))
+    fps = variant.get('fps') or TARGET_FPS
+    return (round(excess, 2), round(aspect_error(variant['width'], variant['height'], args), 3),
+            abs(fps - TARGET_FPS), variant.get('size') or 0)
+
+def select_video(variants, args):
+    # variants is a list of dicts with url, width, height and optionally fps and
+    # size. Returns the best acceptable one, or the reason none of them is.
+    acceptable = []
+    reason = SKIP_NO_FILE
+    for variant in variants:
+        failed = check_video(variant, args)
+        if failed is None:
+            acceptable.append(variant)
+        elif SKIP_REASONS.index(failed) > SKIP_REASONS.index(reason):
+            reason = failed  # Report the check the closest variant failed
+    if not acceptable:
+        return reason
+    return min(acceptable, key=lambda variant: video_score(variant, args))
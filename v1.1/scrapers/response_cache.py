@@ -0,0 +1,105 @@
+# scrapers/response_cache.py
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+DEFAULT_TTL = 24 * 60 * 60  # Pixabay asks clients to cache results for 24 hours
+DEFAULT_MAX_MB = 200
+
+# Query parameters that identify the caller rather than the search
+PRIVATE_PARAMS = {'key'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at);
+"""
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def cache_key(url, ignore=()):
+    # Same search, same key: host lowercased, parameters sorted, API key dropped
+    parts = urlparse(url)
+    params = sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                    if name not in PRIVATE_PARAMS and name not in ignore)
+    return urlunparse((parts.scheme, parts.netloc.lower(), parts.path, '', urlencode(params), ''))
+
+class ResponseCache:
+    # Search responses on disk, shared by every scraper and process using the same file
+    def __init__(self, path, ttl, max_bytes):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = self.connect()
+        connection.executescript(SCHEMA)
+        connection.close()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        connection = self.connect()
+        try:
+            with connection:
+                row = connection.execute("SELECT body, fetched_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                if row[1] + self.ttl < now:
+                    connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    return None
+                connection.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+                return row[0]
+        finally:
+            connection.close()
+
+    def put(self, key, body):
+        now = time.time()
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, body, size, fetched_at, used_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, body, len(body), now, now)
+                )
+                self.evict(connection)
+        finally:
+            connection.close()
+
+    def evict(self, connection):
+        # Least recently used responses go first once the cache is over its size
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        connection.execute("DELETE FROM responses WHERE fetched_at + ? < ?", (self.ttl, time.time()))
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY used_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+        logging.info(f"Search cache trimmed to {total} bytes")
+
+def get_cache(config):
+    # None when caching is turned off
+    ttl = config.get('search_cache_ttl', DEFAULT_TTL)
+    if not ttl:
+        return None
+    path = config.get('search_cache_path') or os.path.join(config.get('metadata_path', 'metadata'), 'search_cache.db')
+    with _caches_lock:
+        if path not in _caches:
+            max_bytes = config.get('search_cache_max_mb', DEFAULT_MAX_MB) * 1024 * 1024
+            _caches[path] = ResponseCache(path, ttl, max_bytes)
+        return _caches[path]
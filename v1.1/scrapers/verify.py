@@ -0,0 +1,65 @@
+# scrapers/verify.py
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from scrapers import catalog, downloader
+
+# Outcomes that mean the file on disk is not the one that was downloaded
+PROBLEMS = ['missing', 'wrong size', 'wrong hash', 'unreadable']
+
+def stat_file(file_name):
+    try:
+        return os.stat(file_name)
+    except OSError:
+        return None
+
+def hash_file(file_name):
+    try:
+        return downloader.file_digest(file_name)['sha256']
+    except OSError as e:
+        logging.error(f"Failed to read {file_name}: {e}")
+        return None
+
+def verify_library(config, website=None, quick=False):
+    # Checks every file in the catalog against the size and SHA-256 recorded
+    # when it was downloaded. Returns {outcome: [file names]}, outcomes being
+    # ok, unhashed (nothing recorded to compare with) and the PROBLEMS.
+    # quick only compares sizes, which costs a stat per file and no reads.
+    catalog_db = catalog.get_catalog(config)
+    catalog_db.flush()
+    files = catalog_db.library_files(website)
+    outcomes = {}
+    # Hashing releases the GIL, so threads read and hash files side by side
+    with ThreadPoolExecutor(max_workers=config.get('verify_workers') or os.cpu_count()) as executor:
+        stats = list(executor.map(stat_file, [file_name for file_name, _, _ in files]))
+
+        # Hard links to one blob are the same bytes, so each is hashed once
+        inodes = {}
+        for (file_name, sha256, size), stat in zip(files, stats):
+            if stat is None:
+                outcome = 'missing'
+            elif size is not None and stat.st_size != size:
+                outcome = 'wrong size'
+            elif not sha256:
+                outcome = 'unhashed' if size is None else 'ok'
+            elif quick:
+                outcome = 'ok'
+            else:
+                inodes.setdefault((stat.st_dev, stat.st_ino), []).append((file_name, sha256))
+                continue
+            outcomes.setdefault(outcome, []).append(file_name)
+
+        groups = list(inodes.values())
+        hashes = executor.map(hash_file, [group[0][0] for group in groups])
+        for group, actual in zip(groups, hashes):
+            for file_name, sha256 in group:
+                outcome = 'unreadable' if actual is None else 'ok' if actual == sha256 else 'wrong hash'
+                outcomes.setdefault(outcome, []).append(file_name)
+
+    for outcome in PROBLEMS:
+        for file_name in outcomes.get(outcome, []):
+            logging.warning(f"Verify: {file_name}: {outcome}")
+    logging.info(f"Verified {len(files)} files: " +
+                 ', '.join(f"{len(names)} {outcome}" for outcome, names in sorted(outcomes.items())))
+    return outcomes
@@ -0,0 +1,216 @@
+# scrapers/workqueue.py
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_LEASE = 300
+DEFAULT_PAGES_PER_UNIT = 5
+MAX_ATTEMPTS = 3
+
+# Arguments that place a unit within its search rather than say what it searches for
+UNIT_ARGS = {'first_page', 'last_page', 'num_results', 'follow_up'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    site TEXT NOT NULL,
+    keyword_set TEXT NOT NULL,
+    first_page INTEGER NOT NULL,
+    last_page INTEGER NOT NULL,
+    args TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    files_saved INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS units_status ON units (status, lease_until);
+CREATE TABLE IF NOT EXISTS claims (
+    website TEXT NOT NULL,
+    content_type TEXT NOT NULL,
+    item_id NOT NULL,
+    file_url TEXT NOT NULL,
+    worker TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    claimed_at REAL NOT NULL,
+    PRIMARY KEY (website, content_type, item_id, file_url)
+);
+DROP TABLE IF EXISTS items;
+"""
+
+CLAIM_KEY = "website = ? AND content_type = ? AND item_id = ? AND file_url = ?"
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+def search_key(args):
+    return json.dumps({name: value for name, value in args.items() if name not in UNIT_ARGS}, sort_keys=True)
+
+class WorkQueue:
+    # Units of work, (site, keyword set, page range), leased to the workers of
+    # several machines. Lives on the shared drive; SQLite's default rollback
+    # journal is kept because WAL does not work over network file systems.
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = self.connect()
+        connection.executescript(SCHEMA)
+        connection.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def transaction(self, func, *args):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can't
+        # both read a unit as free and then both claim it
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(connection, *args)
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return result
+        finally:
+            connection.close()
+
+    def add_units(self, units):
+        def insert(connection):
+            connection.executemany(
+                "INSERT INTO units (site, keyword_set, first_page, last_page, args) VALUES (?, ?, ?, ?, ?)",
+                [(site, keyword_set, first_page, last_page, json.dumps(args))
+                 for site, keyword_set, first_page, last_page, args in units]
+            )
+        self.transaction(insert)
+        return len(units)
+
+    def claim(self, worker, lease):
+        # Returns (unit_id, site, args) of the next free unit, now leased to worker
+        def claim_next(connection):
+            now = time.time()
+            released = connection.execute(
+                "UPDATE units SET status = 'pending', worker = NULL WHERE status = 'leased' AND lease_until < ?", (now,)
+            ).rowcount
+            if released:
+                logging.warning(f"Released {released} units whose lease expired")
+            row = connection.execute("SELECT id, site, args FROM units WHERE status = 'pending' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE units SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker, now + lease, row[0])
+            )
+            return row[0], row[1], json.loads(row[2])
+        return self.transaction(claim_next)
+
+    def add_follow_up(self, unit_id, next_page, num_results):
+        # Queues more pages for a unit whose pages held fewer usable results than
+        # its share: the rest of its own range from next_page, or else the pages
+        # after the last ones planned for its search. Returns the new unit's
+        # (id, first page, last page).
+        def insert(connection):
+            site, keyword_set, first_page, last_page, args = connection.execute(
+                "SELECT site, keyword_set, first_page, last_page, args FROM units WHERE id = ?", (unit_id,)
+            ).fetchone()
+            args = json.loads(args)
+            if next_page <= last_page:
+                pages = (next_page, last_page)
+            else:
+                search = search_key(args)
+                planned = max(row_last_page for row_args, row_last_page in connection.execute(
+                    "SELECT args, last_page FROM units WHERE site = ? AND keyword_set = ?", (site, keyword_set)
+                ) if search_key(json.loads(row_args)) == search)
+                pages = (planned + 1, planned + 1 + last_page - first_page)
+            args = dict(args, first_page=pages[0], last_page=pages[1], num_results=num_results, follow_up=True)
+            new_id = connection.execute(
+                "INSERT INTO units (site, keyword_set, first_page, last_page, args) VALUES (?, ?, ?, ?, ?)",
+                (site, keyword_set, pages[0], pages[1], json.dumps(args))
+            ).lastrowid
+            return new_id, pages[0], pages[1]
+        return self.transaction(insert)
+
+    def renew(self, unit_id, worker, lease, files_saved):
+        # Extends the lease and reports progress; False if the unit was given to another worker
+        def extend(connection):
+            return connection.execute(
+                "UPDATE units SET lease_until = ?, files_saved = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (time.time() + lease, files_saved, unit_id, worker)
+            ).rowcount == 1
+        return self.transaction(extend)
+
+    def finish(self, unit_id, worker, files_saved, error=None):
+        # A failed unit goes back to the queue until it has used up its attempts
+        def complete(connection):
+            if error is None:
+                status = 'done'
+            else:
+                attempts = connection.execute("SELECT attempts FROM units WHERE id = ?", (unit_id,)).fetchone()[0]
+                status = 'failed' if attempts >= MAX_ATTEMPTS else 'pending'
+            connection.execute(
+                "UPDATE units SET status = ?, worker = NULL, lease_until = NULL, files_saved = ?, error = ? "
+                "WHERE id = ? AND worker = ?",
+                (status, files_saved, error, unit_id, worker)
+            )
+        self.transaction(complete)
+
+    def counts(self):
+        # Number of units in each status; leases past their time count as pending
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                "SELECT CASE WHEN status = 'leased' AND lease_until < ? THEN 'pending' ELSE status END, COUNT(*), "
+                "SUM(files_saved) FROM units GROUP BY 1", (time.time(),)
+            ).fetchall()
+        finally:
+            connection.close()
+        return {status: {'units': count, 'files_saved': files_saved or 0} for status, count, files_saved in rows}
+
+    # Items are claimed in the rendition being downloaded: (website, content_type,
+    # item_id, file_url), as a video can share its id with a photo and the file
+    # saved for an item depends on the quality asked for
+    def claim_item(self, website, content_type, item_id, file_url, worker, file_name, take_over=False):
+        # Returns the file name the item is saved under by the worker that claimed
+        # it first, or None if that is this worker
+        item = (website, content_type, item_id, file_url)
+
+        def claim_or_lookup(connection):
+            if take_over:
+                connection.execute("UPDATE claims SET worker = ?, file_name = ?, claimed_at = ? "
+                                   f"WHERE {CLAIM_KEY}", (worker, file_name, time.time()) + item)
+            connection.execute("INSERT OR IGNORE INTO claims (website, content_type, item_id, file_url, worker, "
+                               "file_name, claimed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               item + (worker, file_name, time.time()))
+            owner, owner_file = connection.execute(f"SELECT worker, file_name FROM claims WHERE {CLAIM_KEY}",
+                                                   item).fetchone()
+            return None if owner == worker else owner_file
+        return self.transaction(claim_or_lookup)
+
+    def item_owner(self, website, content_type, item_id, file_url):
+        # (worker, file_name) of the claim on an item, or None if nobody holds it
+        connection = self.connect()
+        try:
+            return connection.execute(f"SELECT worker, file_name FROM claims WHERE {CLAIM_KEY}",
+                                      (website, content_type, item_id, file_url)).fetchone()
+        finally:
+            connection.close()
+
+    def release_item(self, website, content_type, item_id, file_url, worker):
+        # Lets another worker have an item this one failed to download
+        def release(connection):
+            connection.execute(f"DELETE FROM claims WHERE {CLAIM_KEY} AND worker = ?",
+                               (website, content_type, item_id, file_url, worker))
+        self.transaction(release)
+
+def get_queue(config):
+    path = config.get('work_queue_path') or os.path.join(config['database_path'], 'work.db')
+    with _queues_lock:
+        if path not in _queues:
+            _queues[path] = WorkQueue(path)
+        return _queues[path]
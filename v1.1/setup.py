@@ -466,7 +466,51 @@ def create_config(db_path, api_keys):
         "database_path": db_path,
         "api_keys": api_keys,
         "log_level": "INFO",
-        "metadata_path": "metadata"  # Path for metadata files
+        "metadata_path": "metadata",  # Path for metadata files
+        "export_metadata_json": True,  # Rewrite the JSON metadata files after each run
+        "dedupe": True,  # Link files we already have instead of downloading them again
+        "dedupe_link": "hardlink",  # hardlink, symlink or reflink
+        "blob_store": True,  # Store each file once by SHA-256, the folders link to it
+        "near_duplicates": "off",  # off, flag or skip near-duplicate images (needs Pillow)
+        "phash_algorithm": "dhash",  # dhash or phash
+        "phash_max_distance": 6,  # Hamming distance under which two images are near duplicates
+        "parallel_websites": True,  # Scrape the selected websites at the same time
+        "max_in_flight": 100,  # HTTP requests kept in flight by the engine
+        "site_concurrency": 16,  # Search and download requests in flight per site
+        "keyword_set_concurrency": 4,  # Keyword sets scraped at the same time per site
+        "job_concurrency": 4,  # Jobs of a job file run at the same time, per site
+        "work_lease": 300,  # Seconds a worker holds a work unit without reporting progress
+        "network_databases": False,  # Catalog and job queue are on a network drive: use the rollback journal, not WAL
+        "search_lookahead": 1,  # Search pages fetched ahead of the downloads
+        "rate_limits": {  # API quota per site: requests allowed per period in seconds
+            "pexels": {"requests": 200, "period": 3600},
+            "pixabay": {"requests": 100, "period": 60}
+        },
+        "max_rate_limit_wait": 900,  # Longest wait for a quota reset before giving up
+        "search_cache_ttl": 86400,  # Seconds a cached search response stays fresh, 0 turns the cache off
+        "search_cache_max_mb": 200,  # Size of the search cache before old responses are evicted
+        "incremental": False,  # Only fetch results not harvested by earlier runs of the same search
+        "incremental_known_ratio": 0.8,  # Stop paging once this share of a page was harvested before
+        "download_workers": 8,  # Parallel downloads per page
+        "max_connections_per_host": 4,  # Parallel requests against a single host to start from
+        "adaptive_concurrency": True,  # Tune the per-host limit from latency and errors
+        "adaptive_max_connections": 32,  # Highest per-host limit the tuning may reach
+        "segmented_download_threshold": 67108864,  # Files this large (bytes) are downloaded in segments
+        "download_segments": 4,  # Parallel byte ranges per segmented download
+        "download_buffer_size": 262144,  # Bytes read and written at a time by each download
+        "fsync": "off",  # Sync downloaded files to disk: off, file or batch
+        "fsync_batch_size": 64,  # Files synced together with fsync set to batch
+        "bandwidth_limit_mbps": 0,  # Cap on all downloads together in megabits per second, 0 for none
+        "site_bandwidth_limits_mbps": {  # Cap per site in megabits per second, 0 for none
+            "pexels": 0,
+            "pixabay": 0
+        },
+        "http_pool_size": 32,  # Kept-alive connections per host in each site session
+        "http_retries": {  # Retry policy for failed connections and server errors
+            "total": 3,
+            "backoff_factor": 0.5,
+            "status_forcelist": [500, 502, 503, 504]
+        }
     }
     with open("config.json", "w") as f:
         json.dump(config, f, indent=4)
@@ -0,0 +1,67 @@
+# tests/test_adaptive.py
+# Latency alone can't tell when the link is full, so the limit is also trimmed
+# when downloads over more connections bring in no more bytes in total.
+#   python -m pytest tests
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scrapers import adaptive
+
+MB = 1024 * 1024
+
+class ThroughputTest(unittest.TestCase):
+    def setUp(self):
+        self.limit = adaptive.AdaptiveLimit('images.example.com', 8, 32)
+        learned = mock.patch.dict(adaptive._learned)
+        learned.start()
+        self.addCleanup(learned.stop)
+
+    def downloads(self, busy, seconds, count=adaptive.THROUGHPUT_MIN_SAMPLES, size=10 * MB, connections=1):
+        self.limit.in_use = busy
+        for _ in range(count):
+            self.limit.record_transfer(size, seconds, connections)
+
+    def test_full_link_trims_the_limit(self):
+        self.downloads(2, 2.0)  # 10 MB/s in total
+        self.downloads(4, 4.0)  # Still 10 MB/s, each connection got half as much
+        self.assertAlmostEqual(self.limit.limit, 8 * adaptive.THROUGHPUT_DECREASE_FACTOR)
+        self.assertEqual(adaptive._learned['images.example.com'], self.limit.limit)
+
+    def test_growing_throughput_keeps_the_limit(self):
+        self.downloads(2, 2.0)
+        self.downloads(4, 2.5)  # 16 MB/s, more than half the extra connections' share
+        self.assertEqual(self.limit.limit, 8)
+
+    def test_segmented_download_counts_per_connection(self):
+        self.downloads(2, 2.0)
+        # One download over all 4 busy connections, at 10 MB/s in total
+        self.downloads(4, 1.0, connections=4)
+        self.assertLess(self.limit.limit, 8)
+
+    def test_small_downloads_are_ignored(self):
+        self.downloads(2, 0.02, size=100 * 1024)
+        self.downloads(4, 0.04, size=100 * 1024)
+        self.assertEqual(self.limit.throughput, {})
+        self.assertEqual(self.limit.limit, 8)
+
+    def test_too_few_downloads_to_judge(self):
+        self.downloads(2, 2.0)
+        self.downloads(4, 4.0, count=adaptive.THROUGHPUT_MIN_SAMPLES - 1)
+        self.assertEqual(self.limit.limit, 8)
+
+    def test_spare_slots_count_received_bytes(self):
+        throttle = mock.Mock()
+        spare_slots = adaptive.SpareSlots(self.limit, None)
+        count = spare_slots.metered(throttle)
+        count(100)
+        count(50)
+        self.assertEqual(spare_slots.received, 150)
+        self.assertEqual(throttle.call_count, 2)
+        spare_slots.metered(None)(10)
+        self.assertEqual(spare_slots.received, 160)
+
+if __name__ == '__main__':
+    unittest.main()
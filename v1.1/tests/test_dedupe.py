@@ -0,0 +1,121 @@
+# tests/test_dedupe.py
+# A saved item is only reused for the same rendition of the same kind of item:
+# a Pexels video can share its id with a photo, and the file picked for an id
+# depends on the quality asked for.
+#   python -m pytest tests
+import asyncio
+import os
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scrapers import catalog, dedupe, engine, workqueue
+from test_downloader import ServerTest
+
+PHOTO_URL = 'https://images.pexels.com/photos/123/pexels-photo-123.jpeg?h=650&w=940'
+LARGE_PHOTO_URL = 'https://images.pexels.com/photos/123/pexels-photo-123.jpeg?h=1300&w=1880'
+VIDEO_URL = 'https://videos.pexels.com/video-files/123/123-uhd_3840_2160_25fps.mp4'
+
+def fake_adapter():
+    return types.SimpleNamespace(WEBSITE='pexels', SITE_NAME='Pexels', RATE_LIMIT=(200, 3600),
+                                 parse_rate_limit=lambda headers: None)
+
+class KnownFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(catalog.close_all)  # Before the directory goes
+        self.config = {
+            'database_path': os.path.join(self.directory.name, 'db'),
+            'metadata_path': os.path.join(self.directory.name, 'metadata'),
+        }
+        self.photo = os.path.join(self.directory.name, 'photos', '123.jpeg')
+
+    def test_catalog_matches_the_rendition(self):
+        catalog_db = catalog.get_catalog(self.config)
+        catalog_db.add([{'file_name': self.photo, 'file_url': PHOTO_URL, 'website': 'pexels', 'keywords': 'cats',
+                         'categories': [], 'styles': [], 'content_type': 'photos', 'quality': 'HD',
+                         'format': '16:9', 'id': 123, 'sha256': '0' * 64}])
+        catalog_db.flush()
+        self.assertEqual(dedupe.find_known(self.config, 'pexels', 'photos', [(123, PHOTO_URL)]),
+                         {123: [(self.photo, '0' * 64)]})
+        self.assertEqual(dedupe.find_known(self.config, 'pexels', 'photos', [(123, LARGE_PHOTO_URL)]), {})
+        self.assertEqual(dedupe.find_known(self.config, 'pexels', 'videos', [(123, VIDEO_URL)]), {})
+
+    def test_this_run_matches_the_rendition(self):
+        dedupe.remember('pexels', 'photos', 456, PHOTO_URL, self.photo, '1' * 64)
+        self.assertEqual(dedupe.find_known(self.config, 'pexels', 'photos', [(456, PHOTO_URL)]),
+                         {456: [(self.photo, '1' * 64)]})
+        self.assertEqual(dedupe.find_known(self.config, 'pexels', 'photos', [(456, LARGE_PHOTO_URL)]), {})
+        self.assertEqual(dedupe.find_known(self.config, 'pexels', 'videos', [(456, VIDEO_URL)]), {})
+
+    def test_workers_claim_each_rendition(self):
+        queue = workqueue.get_queue(self.config)
+        self.assertIsNone(queue.claim_item('pexels', 'photos', 123, PHOTO_URL, 'one', self.photo))
+        self.assertEqual(queue.claim_item('pexels', 'photos', 123, PHOTO_URL, 'two', 'other.jpeg'), self.photo)
+        self.assertIsNone(queue.claim_item('pexels', 'photos', 123, LARGE_PHOTO_URL, 'two', 'large.jpeg'))
+        self.assertIsNone(queue.claim_item('pexels', 'videos', 123, VIDEO_URL, 'two', '123.mp4'))
+
+class InFlightTest(ServerTest):
+    def setUp(self):
+        super().setUp()
+        self.server.files['/123.mp4'] = os.urandom(200000)
+        self.addCleanup(catalog.close_all)
+        self.config.update({
+            'database_path': os.path.join(self.directory.name, 'db'),
+            'metadata_path': os.path.join(self.directory.name, 'metadata'),
+        })
+
+    def test_video_does_not_wait_for_a_photo_with_its_id(self):
+        def saved_as(content_type, name):
+            os.makedirs(os.path.join(self.directory.name, content_type), exist_ok=True)
+            return os.path.join(self.directory.name, content_type, name)
+
+        async def download_both():
+            client = engine.Client(self.config, fake_adapter())
+            try:
+                return await asyncio.gather(
+                    client.download(self.url('/a.jpg'), saved_as('photos', '123.jpg'), 'photos', 123, []),
+                    client.download(self.url('/a.jpg'), saved_as('photos2', '123.jpg'), 'photos', 123, []),
+                    client.download(self.url('/123.mp4'), saved_as('videos', '123.mp4'), 'videos', 123, []),
+                )
+            finally:
+                client.close()
+
+        photo, linked_photo, video = asyncio.run(download_both())
+        self.assertNotIn('linked_from', photo)
+        self.assertEqual(linked_photo['linked_from'], saved_as('photos', '123.jpg'))
+        self.assertNotIn('linked_from', video)
+        with open(saved_as('videos', '123.mp4'), 'rb') as f:
+            self.assertEqual(f.read(), self.server.files['/123.mp4'])
+
+class ExistingFileTest(ServerTest):
+    def setUp(self):
+        super().setUp()
+        self.config.update({
+            'database_path': os.path.join(self.directory.name, 'db'),
+            'metadata_path': os.path.join(self.directory.name, 'metadata'),
+        })
+        with open(self.file_name, 'wb') as f:
+            f.write(self.server.files['/a.jpg'][:1000])
+
+    def fetch(self, known):
+        return dedupe.fetch_file(self.url('/a.jpg'), self.file_name, 'pexels', 'photos', 1, known, self.session,
+                                 self.config)
+
+    def test_file_without_a_hash_is_checked(self):
+        result = self.fetch([(self.file_name, None)])
+        self.assertEqual(result['size'], 300000)
+        self.assertEqual(self.server.heads, ['/a.jpg'])
+        self.assertEqual(dedupe.find_known(self.config, 'pexels', 'photos', [(1, self.url('/a.jpg'))]),
+                         {1: [(self.file_name, result['sha256'])]})
+
+    def test_file_with_a_recorded_hash_is_kept(self):
+        # verify compares it with the hash recorded when it was downloaded
+        self.assertEqual(self.fetch([(self.file_name, '0' * 64)]), {'sha256': '0' * 64, 'size': 1000})
+        self.assertEqual(self.server.heads, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+# tests/test_downloader.py
+# Resuming .part files against a local server that serves byte ranges.
+#   python -m pytest tests
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scrapers import downloader
+
+class Killed(BaseException):
+    # Stands in for the process being killed: nothing gets to clean up after it
+    pass
+
+class RangeHandler(BaseHTTPRequestHandler):
+    # Serves server.files {path: bytes} with a strong ETag per version, honouring
+    # Range and If-Range. server.range_offset shifts the ranges it sends back,
+    # and server.most_active counts the most range requests served at once.
+    # HEAD only gives the size while server.head_size is set.
+    def do_HEAD(self):
+        self.server.heads.append(self.path)
+        self.send_response(200)
+        if self.server.head_size:
+            self.send_header('Content-Length', str(len(self.server.files[self.path])))
+        self.end_headers()
+
+    def do_GET(self):
+        ranged = 'Range' in self.headers
+        with self.server.lock:
+            self.server.active += ranged
+            self.server.most_active = max(self.server.most_active, self.server.active)
+        try:
+            self.send_file()
+        except ConnectionError:
+            pass  # The client only wanted the headers, as for a segmented download
+        finally:
+            with self.server.lock:
+                self.server.active -= ranged
+
+    def send_file(self):
+        body = self.server.files[self.path]
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        start, end = 0, len(body) - 1
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range', etag) == etag:
+            start = int(match[1]) + self.server.range_offset
+            end = min(int(match[2]), end) if match[2] else end
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        time.sleep(0.05)  # Long enough for parallel ranges to overlap
+        self.wfile.write(body[start:end + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.files = {'/a.jpg': os.urandom(300000), '/b.jpg': os.urandom(300000)}
+        self.server.range_offset = 0
+        self.server.requests = []
+        self.server.heads = []
+        self.server.head_size = True
+        self.server.lock = threading.Lock()
+        self.server.active = self.server.most_active = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.session = requests.Session()
+        self.addCleanup(self.session.close)
+        self.config = {'download_segments': 1}
+        self.file_name = os.path.join(self.directory.name, '1.jpg')
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_address[1]}{path}"
+
+    def interrupted(self, path, size):
+        # A .part file as a run killed after size bytes of path leaves it
+        downloader.save_source(self.file_name + '.part', self.url(path), self.session.get(self.url(path)))
+        with open(self.file_name + '.part', 'wb') as f:
+            f.write(self.server.files[path][:size])
+        self.server.requests.clear()
+
+    def assertSaved(self, result, path):
+        body = self.server.files[path]
+        self.assertEqual(result, {'sha256': hashlib.sha256(body).hexdigest(), 'size': len(body)})
+        with open(self.file_name, 'rb') as f:
+            self.assertEqual(f.read(), body)
+        self.assertEqual([name for name in os.listdir(self.directory.name)], ['1.jpg'])
+
+class DownloaderTest(ServerTest):
+    def test_resumes_from_the_part_file(self):
+        self.interrupted('/a.jpg', 1000)
+        result = downloader.download_file(self.url('/a.jpg'), self.file_name, self.session, self.config)
+        self.assertSaved(result, '/a.jpg')
+        self.assertEqual(self.server.requests, [('/a.jpg', 'bytes=1000-')])
+
+    def test_part_file_from_another_url_is_restarted(self):
+        self.interrupted('/a.jpg', 1000)
+        result = downloader.download_file(self.url('/b.jpg'), self.file_name, self.session, self.config)
+        self.assertSaved(result, '/b.jpg')
+        self.assertEqual(self.server.requests, [('/b.jpg', None)])
+
+    def test_changed_file_is_restarted(self):
+        self.interrupted('/a.jpg', 1000)
+        self.server.files['/a.jpg'] = os.urandom(300000)
+        result = downloader.download_file(self.url('/a.jpg'), self.file_name, self.session, self.config)
+        self.assertSaved(result, '/a.jpg')
+        self.assertEqual(self.server.requests, [('/a.jpg', 'bytes=1000-')])  # Sent whole, with a 200
+
+    def test_range_from_the_wrong_byte_is_restarted(self):
+        self.interrupted('/a.jpg', 1000)
+        self.server.range_offset = 10
+        result = downloader.download_file(self.url('/a.jpg'), self.file_name, self.session, self.config)
+        self.server.range_offset = 0
+        self.assertSaved(result, '/a.jpg')
+        self.assertEqual(self.server.requests, [('/a.jpg', 'bytes=1000-'), ('/a.jpg', None)])
+
+class ExistingFileTest(ServerTest):
+    def existing(self, size):
+        # A file as saved before downloads went through .part files
+        with open(self.file_name, 'wb') as f:
+            f.write(self.server.files['/a.jpg'][:size])
+
+    def test_complete_file_is_kept(self):
+        self.existing(300000)
+        result = downloader.download_file(self.url('/a.jpg'), self.file_name, self.session, self.config)
+        self.assertSaved(result, '/a.jpg')
+        self.assertEqual(self.server.requests, [])
+
+    def test_truncated_file_is_downloaded_again(self):
+        self.existing(1000)
+        result = downloader.download_file(self.url('/a.jpg'), self.file_name, self.session, self.config)
+        self.assertSaved(result, '/a.jpg')
+        self.assertEqual(self.server.requests, [('/a.jpg', None)])
+
+    def test_file_is_unverified_without_a_size(self):
+        self.server.head_size = False
+        self.existing(1000)
+        result = downloader.download_file(self.url('/a.jpg'), self.file_name, self.session, self.config)
+        self.assertEqual(result, {'sha256': None, 'size': None})
+        self.assertEqual(os.path.getsize(self.file_name), 1000)
+
+class PreallocatedTest(ServerTest):
+    def setUp(self):
+        super().setUp()
+        self.server.files['/video.mp4'] = os.urandom(1000000)
+        self.config = {'download_segments': 1, 'download_buffer_size': 16384}
+        patch = mock.patch.object(downloader, 'PROGRESS_BYTES', 65536)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_killed_download_resumes_where_it_got_to(self):
+        written = []
+        save_segments = downloader.save_segments
+
+        def kill_after_half(size):
+            written.append(size)
+            if sum(written) > 500000:
+                raise Killed()
+
+        def save_until_killed(segments_file, state):
+            # A killed process doesn't get to save its progress on the way out
+            if sum(written) <= 500000:
+                save_segments(segments_file, state)
+
+        with self.assertRaises(Killed), mock.patch.object(downloader, 'save_segments', save_until_killed):
+            downloader.download_file(self.url('/video.mp4'), self.file_name, self.session, self.config,
+                                     kill_after_half)
+        self.assertEqual(os.path.getsize(self.file_name + '.part'), 1000000)
+        with open(self.file_name + '.part.segments') as f:
+            saved = json.load(f)['segments'][0][2]
+        self.assertGreater(saved, 500000 - 2 * 65536)
+
+        self.server.requests.clear()
+        result = downloader.download_file(self.url('/video.mp4'), self.file_name, self.session, self.config)
+        self.assertSaved(result, '/video.mp4')
+        self.assertEqual(self.server.requests, [('/video.mp4', f'bytes={saved}-999999')])
+
+class SegmentedTest(ServerTest):
+    def setUp(self):
+        super().setUp()
+        self.server.files['/video.mp4'] = os.urandom(1000000)
+        self.config = {'download_segments': 4, 'segmented_download_threshold': 100000, 'download_buffer_size': 16384}
+        patch = mock.patch.object(downloader, 'PROGRESS_BYTES', 65536)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_killed_download_resumes_each_range_where_it_got_to(self):
+        written = []
+
+        def kill_after_half(size):
+            written.append(size)
+            if sum(written) > 500000:
+                raise Killed()
+
+        with self.assertRaises(Killed):
+            downloader.download_file(self.url('/video.mp4'), self.file_name, self.session, self.config,
+                                     kill_after_half)
+        with open(self.file_name + '.part.segments') as f:
+            saved = sum(segment[2] - segment[0] for segment in json.load(f)['segments'])
+        self.assertGreater(saved, 250000)
+
+        self.server.requests.clear()
+        result = downloader.download_file(self.url('/video.mp4'), self.file_name, self.session, self.config)
+        self.assertSaved(result, '/video.mp4')
+        ranges = [byte_range.split('=')[1].split('-') for _, byte_range in self.server.requests]
+        self.assertEqual(sum(int(last) - int(first) + 1 for first, last in ranges), 1000000 - saved)
+
+    def test_unreadable_progress_starts_over(self):
+        with open(self.file_name + '.part', 'wb') as f:
+            f.write(b'\0' * 1000000)
+        with open(self.file_name + '.part.segments', 'w') as f:
+            f.write('{"total_size": 1000000, "segm')
+        downloader.save_source(self.file_name + '.part', self.url('/video.mp4'), self.session.get(self.url('/video.mp4')))
+        result = downloader.download_file(self.url('/video.mp4'), self.file_name, self.session, self.config)
+        self.assertSaved(result, '/video.mp4')
+
+    def test_connections_are_limited_by_spare_slots(self):
+        spare_slots = mock.Mock()
+        spare_slots.take.return_value = 1
+        result = downloader.download_file(self.url('/video.mp4'), self.file_name, self.session, self.config,
+                                          None, spare_slots)
+        self.assertSaved(result, '/video.mp4')
+        spare_slots.take.assert_called_once_with(3)
+        spare_slots.give_back.assert_called_once_with(1)
+        self.assertEqual(self.server.most_active, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# tests/test_engine.py
+# A keyword set that fails stops the rest of the run with it, so nothing is
+# downloaded for a job after it has been marked failed.
+#   python -m pytest tests
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scrapers import engine
+from test_resume import PER_PAGE, fake_adapter
+
+class SlowClient:
+    # Downloads take a moment each; the search for "broken" fails on its second page
+    def __init__(self):
+        self.downloads = []
+
+    async def call(self, func, *args):
+        return func(*args)
+
+    async def search(self, url, headers=None):
+        query = parse_qs(urlparse(url).query)
+        page = int(query['page'][0])
+        if query['query'][0] == 'broken' and page == 2:
+            raise RuntimeError("Fake API quota exhausted")
+        return {'items': [{'id': f"{query['query'][0]}-{page}-{index}"} for index in range(PER_PAGE)]}
+
+    async def download(self, url, file_name, content_type, item_id, known, flow=None):
+        await asyncio.sleep(0.01)
+        self.downloads.append(item_id)
+        return {'sha256': '0' * 64, 'size': 1}
+
+class CancelTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.config = {
+            'database_path': os.path.join(self.directory.name, 'db'),
+            'metadata_path': os.path.join(self.directory.name, 'metadata'),
+            'export_metadata_json': False,
+            'dedupe': False,
+        }
+
+    def test_failed_keyword_set_cancels_the_others(self):
+        client = SlowClient()
+        args = {'keyword_sets': ['broken', 'long'], 'num_results': 200, 'content_type': '1', 'quality': 'HD',
+                'format': '16:9', 'format_sanitized': '16-9', 'categories': [], 'styles': []}
+
+        async def scrape():
+            with self.assertRaises(RuntimeError):
+                await engine.run(fake_adapter(), args, self.config, client)
+            downloaded = len(client.downloads)
+            await asyncio.sleep(0.2)
+            return downloaded
+
+        downloaded = asyncio.run(scrape())
+        self.assertEqual(len(client.downloads), downloaded)
+        self.assertLess(downloaded, 200)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# tests/test_pexels_scraper.py
+# The size filter sent to Pexels must never drop results that meet the quality.
+#   python -m pytest tests
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scrapers import pexels_scraper, renditions
+
+class SizeFilterTest(unittest.TestCase):
+    def test_photo_filters(self):
+        # 2 MP and 1 MP photos meet 1080P and HD, below even the small filter's 4 MP
+        self.assertEqual([pexels_scraper.size_filter('photos', quality) for quality in ['HD', '1080P', 'UHD', '4K']],
+                         [None, None, 'small', 'small'])
+
+    def test_video_filters(self):
+        self.assertEqual([pexels_scraper.size_filter('videos', quality) for quality in ['HD', '1080P', 'UHD', '4K']],
+                         ['small', 'medium', 'large', 'large'])
+
+    def test_filter_is_never_stricter_than_the_quality(self):
+        minimums = {content_type: dict(sizes) for content_type, sizes in pexels_scraper.SIZES.items()}
+        for quality, (long_side, short_side) in renditions.QUALITY_SIZES.items():
+            size = pexels_scraper.size_filter('photos', quality)
+            if size:
+                self.assertLessEqual(minimums['photos'][size], long_side * short_side, quality)
+            size = pexels_scraper.size_filter('videos', quality)
+            if size:
+                self.assertLessEqual(minimums['videos'][size][0], long_side, quality)
+                self.assertLessEqual(minimums['videos'][size][1], short_side, quality)
+
+    def test_search_url(self):
+        config = {'api_keys': {'pexels': 'key'}}
+        args = {'quality': 'HD', 'format': '16:9'}
+        url, headers = pexels_scraper.build_search_request('cats', 'photos', 2, args, config)
+        self.assertEqual(url, "https://api.pexels.com/v1/search?query=cats&per_page=80&page=2&orientation=landscape")
+        self.assertEqual(headers, {'Authorization': 'key'})
+        url, _ = pexels_scraper.build_search_request('cats', 'videos', 1, dict(args, format='9:16'), config)
+        self.assertTrue(url.endswith("&orientation=portrait&size=small"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# tests/test_renditions.py
+# Video renditions: the tolerant checks and the ranking between acceptable files.
+#   python -m pytest tests
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scrapers import renditions
+
+LANDSCAPE_1080P = {'quality': '1080P', 'format': '16:9'}
+
+def video(width, height, fps=None, size=None, url=None):
+    if url is None:
+        url = f"https://videos.test/{width}x{height}-{fps}-{size}.mp4"
+    return {'url': url, 'width': width,
+            'height': height, 'fps': fps, 'size': size}
+
+class CheckVideoTest(unittest.TestCase):
+    def test_reasons(self):
+        self.assertEqual(renditions.check_video(video(1920, 1080, url=''), LANDSCAPE_1080P), renditions.SKIP_NO_FILE)
+        self.assertEqual(renditions.check_video(video(1920, None), LANDSCAPE_1080P), renditions.SKIP_NO_FILE)
+        self.assertEqual(renditions.check_video(video(1080, 1920), LANDSCAPE_1080P), renditions.SKIP_ORIENTATION)
+        self.assertEqual(renditions.check_video(video(1440, 1080), LANDSCAPE_1080P), renditions.SKIP_ASPECT)
+        self.assertEqual(renditions.check_video(video(1280, 720), LANDSCAPE_1080P), renditions.SKIP_RESOLUTION)
+
+    def test_tolerates_frames_close_to_the_standard(self):
+        self.assertIsNone(renditions.check_video(video(1920, 1080), LANDSCAPE_1080P))
+        self.assertIsNone(renditions.check_video(video(1920, 1012), LANDSCAPE_1080P))
+        self.assertIsNone(renditions.check_video(video(4096, 2160), {'quality': '4K', 'format': '16:9'}))
+        self.assertIsNone(renditions.check_video(video(1080, 1920), {'quality': '1080P', 'format': '9:16'}))
+
+class SelectVideoTest(unittest.TestCase):
+    def test_prefers_the_closest_to_the_quality(self):
+        chosen = renditions.select_video([video(3840, 2160), video(1920, 1080), video(1280, 720)], LANDSCAPE_1080P)
+        self.assertEqual((chosen['width'], chosen['height']), (1920, 1080))
+
+    def test_then_the_closest_to_the_format(self):
+        chosen = renditions.select_video([video(1920, 1012), video(1920, 1080)], LANDSCAPE_1080P)
+        self.assertEqual(chosen['height'], 1080)
+
+    def test_then_the_closest_to_30_fps_then_the_fewest_bytes(self):
+        chosen = renditions.select_video([video(1920, 1080, 60, 100), video(1920, 1080, 25, 50),
+                                          video(1920, 1080, 30, 90), video(1920, 1080, 30, 80)], LANDSCAPE_1080P)
+        self.assertEqual((chosen['fps'], chosen['size']), (30, 80))
+
+    def test_reports_the_check_the_closest_file_failed(self):
+        self.assertEqual(renditions.select_video([], LANDSCAPE_1080P), renditions.SKIP_NO_FILE)
+        self.assertEqual(renditions.select_video([video(1080, 1920), video(1280, 720)], LANDSCAPE_1080P),
+                         renditions.SKIP_RESOLUTION)
+        self.assertEqual(renditions.select_video([video(1080, 1920), video(1440, 1080)], LANDSCAPE_1080P),
+                         renditions.SKIP_ASPECT)
+
+if __name__ == '__main__':
+    unittest.main()
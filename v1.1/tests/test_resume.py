@@ -0,0 +1,136 @@
+# tests/test_resume.py
+# A search that fails part way must leave its job unfinished, so resume picks
+# it up from the checkpoint instead of the job being marked done. Resume leaves
+# alone the jobs another process is still running.
+#   python -m pytest tests
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import types
+import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scrapers import batch, engine, jobqueue
+
+PER_PAGE = 5
+
+def fake_adapter():
+    return types.SimpleNamespace(
+        WEBSITE='fake',
+        SITE_NAME='Fake',
+        PER_PAGE=PER_PAGE,
+        get_content_type=lambda args: 'photos',
+        build_query=lambda keyword_set, args: keyword_set,
+        build_search_request=lambda query, content_type, page, args, config: (
+            f"https://fake.test/search?query={query}&page={page}", None),
+        get_items=lambda data, content_type: data['items'],
+        select_file=lambda item, args, content_type: (f"https://fake.test/files/{item['id']}.jpg", '.jpg'),
+        item_metadata=lambda item: {},
+    )
+
+class FakeClient:
+    # Serves PER_PAGE results per page, and a server error for the pages in failing
+    def __init__(self, failing):
+        self.failing = failing
+        self.pages = []
+
+    async def call(self, func, *args):
+        return func(*args)
+
+    async def search(self, url, headers=None):
+        page = int(parse_qs(urlparse(url).query)['page'][0])
+        self.pages.append(page)
+        if page in self.failing:
+            return None
+        return {'items': [{'id': page * 100 + index} for index in range(PER_PAGE)]}
+
+    async def download(self, url, file_name, content_type, item_id, known, flow=None):
+        return {'sha256': f"{item_id:064x}", 'size': 1}
+
+    def close(self):
+        pass
+
+class FailedSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = {
+            'database_path': os.path.join(self.directory.name, 'db'),
+            'metadata_path': os.path.join(self.directory.name, 'metadata'),
+            'api_keys': {'fake': 'key'},
+            'export_metadata_json': False,
+        }
+        self.job = batch.job_args({'name': 'cats', 'sites': ['fake'], 'keywords': ['cats'], 'count': 15}, 1)
+        self.clients = []
+        patches = [
+            mock.patch.dict(batch.ADAPTERS, {'fake': fake_adapter()}),
+            mock.patch.object(engine, 'Client', self.make_client),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.failing = {2}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_client(self, config, adapter):
+        self.clients.append(FakeClient(self.failing))
+        return self.clients[-1]
+
+    def test_engine_reports_unfinished_keyword_sets(self):
+        queue = jobqueue.get_queue(self.config)
+        job_id = queue.add('fake', self.job)
+        client = FakeClient(self.failing)
+        with self.assertRaises(engine.IncompleteRun) as raised:
+            asyncio.run(engine.run(fake_adapter(), self.job, self.config, client, job_id))
+        self.assertEqual(raised.exception.unfinished, ['cats'])
+        self.assertEqual(raised.exception.results, {'cats': PER_PAGE})
+        checkpoint = queue.load_checkpoint(job_id, 'cats')
+        self.assertFalse(checkpoint['done'])
+        self.assertEqual(checkpoint['page'], 2)
+
+    def test_failed_job_is_resumed_from_its_checkpoint(self):
+        summary = asyncio.run(batch.run_jobs([self.job], self.config))
+        self.assertEqual(summary['status'], 'failed')
+        self.assertEqual(summary['downloaded'], PER_PAGE)
+        unfinished = jobqueue.get_queue(self.config).unfinished()
+        self.assertEqual(len(unfinished), 1)
+
+        self.failing.clear()
+        summary = asyncio.run(batch.run_jobs(batch.unfinished_jobs(self.config), self.config))
+        self.assertEqual(summary['status'], 'ok')
+        self.assertEqual(self.clients[-1].pages, [2, 3])
+        self.assertEqual(summary['jobs'][0]['downloaded'], {'cats': 15})
+        self.assertEqual(jobqueue.get_queue(self.config).unfinished(), [])
+
+class UnfinishedJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.queue = jobqueue.JobQueue(os.path.join(self.directory.name, 'jobs.db'))
+
+    def add(self, name, status, **args):
+        job_id = self.queue.add('fake', dict(batch.job_args({'name': name, 'sites': ['fake'], 'keywords': [name]}, 1),
+                                             **args))
+        self.queue.set_status(job_id, status)
+        return job_id
+
+    def test_leaves_live_jobs_and_work_units_alone(self):
+        self.add('live', 'running')
+        crashed = self.add('crashed', 'running')
+        self.queue.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?",
+                           (time.time() - jobqueue.STALE_AFTER - 1, crashed))
+        failed = self.add('failed', 'failed')
+        self.add('unit', 'failed', first_page=1, last_page=5)
+        self.add('finished', 'done')
+        self.assertEqual([job_id for job_id, _, _ in self.queue.unfinished()], [crashed, failed])
+
+        self.queue.heartbeat(crashed)
+        self.assertEqual([job_id for job_id, _, _ in self.queue.unfinished()], [failed])
+
+if __name__ == '__main__':
+    unittest.main()
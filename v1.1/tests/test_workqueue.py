@@ -0,0 +1,80 @@
+# tests/test_workqueue.py
+# Units are leased to one worker at a time: an expired lease goes back to the
+# queue, the old worker can no longer renew or finish it, and a short unit's
+# follow-up picks up the pages it did not reach.
+#   python -m pytest tests
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scrapers import workqueue
+
+def unit(first_page, last_page, keywords='cats'):
+    return ('pexels', keywords, first_page, last_page,
+            {'keywords': keywords, 'first_page': first_page, 'last_page': last_page, 'num_results': 10})
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.queue = workqueue.WorkQueue(os.path.join(self.directory.name, 'queue.db'))
+        self.now = 1000.0
+        clock = mock.patch.object(workqueue.time, 'time', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def test_units_are_claimed_once(self):
+        self.queue.add_units([unit(1, 5), unit(6, 10)])
+        first = self.queue.claim('a', 60)
+        second = self.queue.claim('b', 60)
+        self.assertEqual((first[1], first[2]['first_page']), ('pexels', 1))
+        self.assertEqual(second[2]['first_page'], 6)
+        self.assertIsNone(self.queue.claim('c', 60))
+        self.assertEqual(self.queue.counts()['leased']['units'], 2)
+
+    def test_expired_lease_is_taken_over(self):
+        self.queue.add_units([unit(1, 5)])
+        unit_id = self.queue.claim('a', 60)[0]
+        self.now += 30
+        self.assertIsNone(self.queue.claim('b', 60))
+        self.assertTrue(self.queue.renew(unit_id, 'a', 60, 3))
+        self.now += 61
+        self.assertEqual(self.queue.counts()['pending'], {'units': 1, 'files_saved': 3})
+        self.assertEqual(self.queue.claim('b', 60)[0], unit_id)
+        # The worker that lost the unit can neither keep it nor close it
+        self.assertFalse(self.queue.renew(unit_id, 'a', 60, 4))
+        self.queue.finish(unit_id, 'a', 4)
+        self.assertEqual(self.queue.counts()['leased']['units'], 1)
+        self.queue.finish(unit_id, 'b', 5)
+        self.assertEqual(self.queue.counts(), {'done': {'units': 1, 'files_saved': 5}})
+
+    def test_failed_unit_retries_until_out_of_attempts(self):
+        self.queue.add_units([unit(1, 5)])
+        for attempt in range(workqueue.MAX_ATTEMPTS):
+            unit_id = self.queue.claim('a', 60)[0]
+            self.queue.finish(unit_id, 'a', 0, error='timeout')
+        self.assertEqual(self.queue.counts()['failed']['units'], 1)
+        self.assertIsNone(self.queue.claim('a', 60))
+
+    def test_follow_up_continues_own_range(self):
+        self.queue.add_units([unit(1, 5)])
+        unit_id = self.queue.claim('a', 60)[0]
+        new_id, first_page, last_page = self.queue.add_follow_up(unit_id, 3, 4)
+        self.assertEqual((first_page, last_page), (3, 5))
+        self.queue.finish(unit_id, 'a', 6)
+        claimed = self.queue.claim('b', 60)
+        self.assertEqual(claimed[0], new_id)
+        self.assertEqual(claimed[2], {'keywords': 'cats', 'first_page': 3, 'last_page': 5,
+                                      'num_results': 4, 'follow_up': True})
+
+    def test_follow_up_goes_past_the_planned_pages(self):
+        # Only units of the same search count towards the pages already planned
+        self.queue.add_units([unit(1, 5), unit(6, 10), unit(1, 20, keywords='dogs')])
+        unit_id = self.queue.claim('a', 60)[0]
+        self.assertEqual(self.queue.add_follow_up(unit_id, 6, 2)[1:], (11, 15))
+
+if __name__ == '__main__':
+    unittest.main()